@@ -26,16 +26,14 @@ import pylab as pl
 import time
 import shelve
 import multiprocessing as mp 
-import itertools
-import cPickle
 import argparse
 
 #AGNfitter IMPORTS
-from functions import  MCMC_AGNfitter, PLOTandWRITE_AGNfitter
+from functions import  MCMC_AGNfitter, GRID_AGNfitter, PLOTandWRITE_AGNfitter
 import functions.PARAMETERSPACE_AGNfitter as parspace
 from functions.DATA_AGNfitter import DATA, DATA_all
 from functions.PLOTandWRITE_AGNfitter import CHAIN, FLUXES_ARRAYS
-from functions.DICTIONARIES_AGNfitter import MODELSDICT
+from functions.DICTIONARIES_AGNfitter import MODELSDICT, load_modelsdict
 import functions.CONSTRUCT_modelobjects as MODELFILES
 from astropy import units as u
 
@@ -61,13 +59,14 @@ def header():
     return
 
 
-def MAKE_model_dictionary(cat, filters, clobbermodel=False):
+def MAKE_model_dictionary(cat, filters, clobbermodel=False, processes=1):
     """
     Create model dictionary for all redshifts in z-array and filters
     input 
         cat - catalog settings
         filters - filter settings
         clobbermodel - remove any existing dictionary (default - False)
+        processes - number of processes sharing the redshifts (default - 1)
     ouput
         modelsdict
     """
@@ -83,12 +82,19 @@ def MAKE_model_dictionary(cat, filters, clobbermodel=False):
         MODELFILES.construct(cat['path'])
 
         mydict = MODELSDICT(cat['dict_path'], cat['path'], filters)
-        mydict.build()
+        mydict.build(processes=processes)
         
         print '_____________________________________________________'
         print 'For this dictionary creation %.2g min elapsed'% ((time.time() - t0)/60.)
 
-    Modelsdict = cPickle.load(file(cat['dict_path'], 'rb'))
+    Modelsdict = load_modelsdict(cat['dict_path'])
+
+    # construct only the redshifts and bands missing in an existing dictionary
+    t0= time.time()
+    mydict = MODELSDICT(cat['dict_path'], cat['path'], filters)
+    if mydict.update(Modelsdict, processes=processes):
+        print '_____________________________________________________'
+        print 'For this dictionary update %.2g min elapsed'% ((time.time() - t0)/60.)
     
     return Modelsdict
 
@@ -120,13 +126,14 @@ def MAKE_model_dictionary_zrange(cat, filters, clobbermodel=False):
         print '_____________________________________________________'
         print 'For this dictionary creation %.2g min elapsed'% ((time.time() - t0)/60.)
 
-    Modelsdict = cPickle.load(file(cat['dict_path'], 'rb'))
+    Modelsdict = load_modelsdict(cat['dict_path'])
     
     return Modelsdict
 
-def RUN_AGNfitter_onesource_independent(cat, line, data_obj, filtersz, clobbermodel=False):
+def RUN_AGNfitter_onesource_independent(cat, line, data_obj, filtersz, clobbermodel=False, resume=False):
     """
     Main function for fitting a single source in line 'line' and create it's modelsdict independently.
+    With resume, the sampling continues from its last checkpoint.
     """
     
     mc = MCMC_settings()
@@ -162,7 +169,7 @@ def RUN_AGNfitter_onesource_independent(cat, line, data_obj, filtersz, clobbermo
         print '_____________________________________________________'
         print 'For this dictionary creation %.2g min elapsed'% ((time.time() - t0)/60.)
     else:
-        Modelsdictz = cPickle.load(file(dictz, 'rb')) 
+        Modelsdictz = load_modelsdict(dictz)
 
     data.DICTS(filtersz, Modelsdictz)
 
@@ -172,7 +179,10 @@ def RUN_AGNfitter_onesource_independent(cat, line, data_obj, filtersz, clobbermo
 
     t1= time.time()
 
-    MCMC_AGNfitter.main(data, P, mc)        
+    if mc.get('engine', 'emcee') in ('grid', 'catalog'):
+        GRID_AGNfitter.main(data, P, mc)
+    else:
+        MCMC_AGNfitter.main(data, P, mc, resume)        
     print 'fitting took %.2g min'% ((time.time() - t1)/60.)
     
     t2= time.time()
@@ -184,9 +194,10 @@ def RUN_AGNfitter_onesource_independent(cat, line, data_obj, filtersz, clobbermo
     print 'Processing this source took %.2g min '% ((time.time() - t0)/60.)
     return
 
-def RUN_AGNfitter_onesource(cat, line, data_obj, modelsdict):
+def RUN_AGNfitter_onesource(cat, line, data_obj, modelsdict, resume=False):
     """
     Main function for fitting a single source in line 'line'.
+    With resume, the sampling continues from its last checkpoint.
     """
     
     t0= time.time()
@@ -195,7 +206,7 @@ def RUN_AGNfitter_onesource(cat, line, data_obj, modelsdict):
     out = OUTPUT_settings()
 
     data = DATA(data_obj,line)
-    data.DICTS(filters, Modelsdict)
+    data.DICTS(filters, modelsdict)
 
     P = parspace.Pdict (data)  # Dictionary with all parameter space especifications.
                                 # From PARAMETERSPACE_AGNfitter.py
@@ -208,7 +219,10 @@ def RUN_AGNfitter_onesource(cat, line, data_obj, modelsdict):
 
 
     t1= time.time()
-    MCMC_AGNfitter.main(data, P, mc)       
+    if mc.get('engine', 'emcee') in ('grid', 'catalog'):
+        GRID_AGNfitter.main(data, P, mc)
+    else:
+        MCMC_AGNfitter.main(data, P, mc, resume)       
     print 'fitting took %.2g min'% ((time.time() - t1)/60.) 
     
     t2= time.time()
@@ -221,13 +235,23 @@ def RUN_AGNfitter_onesource(cat, line, data_obj, modelsdict):
     return
 
     
-def multi_run_wrapper(args):
+def multi_run_init(cat, data_obj, modelsdict, resume=False):
     """
-    wrapper to allow calling RUN_AGNfitter_onesource in pool.map
+    Initializer of the processes of RUN_AGNfitter_multiprocessing:
+    installs the catalog and the model dictionary once in each process.
     """
-    return RUN_AGNfitter_onesource(*args)
+    global multi_run_state
+    multi_run_state = cat, data_obj, modelsdict, resume
 
-def RUN_AGNfitter_multiprocessing(cat, processors, data_obj, modelsdict):
+def multi_run_wrapper(line):
+    """
+    wrapper to allow calling RUN_AGNfitter_onesource in pool.map,
+    with the catalog and the model dictionary of the process (multi_run_init)
+    """
+    cat, data_obj, modelsdict, resume = multi_run_state
+    return RUN_AGNfitter_onesource(cat, line, data_obj, modelsdict, resume)
+
+def RUN_AGNfitter_multiprocessing(cat, processors, data_obj, modelsdict, resume=False):
     """
     Main function for fitting all sources in a large catalog.
     Splits the job of running the large number of sources
@@ -240,8 +264,9 @@ def RUN_AGNfitter_multiprocessing(cat, processors, data_obj, modelsdict):
     
     print "processing all {0:d} sources with {1:d} cpus".format(nsources, processors)
     
-    pool = mp.Pool(processes = processors)
-    catalog_fitting = pool.map(multi_run_wrapper, itertools.izip(range(nsources), itertools.repeat(data_obj), itertools.repeat(modelsdict)))
+    # the tasks are only the lines of the sources, one at a time (each one is a whole fit)
+    pool = mp.Pool(processes = processors, initializer=multi_run_init, initargs=(cat, data_obj, modelsdict, resume))
+    catalog_fitting = pool.map(multi_run_wrapper, range(nsources), chunksize=1)
     pool.close()
     pool.join()
     ##WRITE ALL RESULST IN ONE TABLE
@@ -258,6 +283,8 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--sourcenumber", type=int, default=-1, help="specify a single source number to run (this is the line number in hte catalogue not the source id/name)")
     parser.add_argument("-i","--independent", action="store_true", help="run independently per source, i.e. do not create a global model dictionary")
     parser.add_argument("-o","--overwrite", action="store_true", help="overwrite model files")
+    parser.add_argument("-p","--precision", action="store_true", help="compare the fit with the model dictionary in single precision (float32) and in double precision, for each source, and exit")
+    parser.add_argument("-r","--resume", action="store_true", help="continue the sampling of each source from its last checkpoint (mc['checkpoint']), skipping the sources already sampled")
     
     
     
@@ -291,26 +318,42 @@ if __name__ == "__main__":
 
     # run for once source only and construct dictionary only for this source
     if args.independent:
-        RUN_AGNfitter_onesource_independent(cat, args.sourcenumber, data_ALL, filters, clobbermodel=clobbermodel)
+        RUN_AGNfitter_onesource_independent(cat, args.sourcenumber, data_ALL, filters, clobbermodel=clobbermodel, resume=args.resume)
         
     else:
         
         if 'dict_zarray' not in filters.keys():
-            filters['dict_zarray'] = np.unique(data_ALL.z)
+            if filters.get('z_interpolation', False):
+                # grid of spacing 0.02 bracketing the redshifts of the catalog
+                filters['dict_zarray'] = np.round(np.arange(np.floor(data_ALL.z.min()*50.)/50., data_ALL.z.max()+0.02, 0.02), 2)
+            else:
+                filters['dict_zarray'] = np.unique(data_ALL.z)
             
         
         # make/read the model dictionary
-        Modelsdict = MAKE_model_dictionary(cat, filters, clobbermodel=clobbermodel)
-
+        Modelsdict = MAKE_model_dictionary(cat, filters, clobbermodel=clobbermodel, processes=args.ncpu)
+
+        # validation of the single precision mode (filters['float32'])
+        if args.precision:
+            lines = [args.sourcenumber] if args.sourcenumber >= 0 else range(data_ALL.cat['nsources'])
+            filters['float32'] = False
+            for line in lines:
+                data = DATA(data_ALL, line)
+                data.DICTS(filters, Modelsdict)
+                print '- Sourcename: ', data.name
+                parspace.precision_report(data, parspace.Pdict(data))
         # a single source is specified
-        if args.sourcenumber >= 0:
-            RUN_AGNfitter_onesource(cat, args.sourcenumber, data_ALL, Modelsdict)
+        elif args.sourcenumber >= 0:
+            RUN_AGNfitter_onesource(cat, args.sourcenumber, data_ALL, Modelsdict, args.resume)
+        # grid fit of the whole catalog, by redshift of the dictionary
+        elif MCMC_settings().get('engine', 'emcee') == 'catalog':
+            GRID_AGNfitter.main_catalog(data_ALL, filters, Modelsdict, MCMC_settings())
         else:
             if args.ncpu == 1:
                 for line in range(data_ALL.cat['nsources']):
-                    RUN_AGNfitter_onesource(cat, line, data_ALL, Modelsdict)
+                    RUN_AGNfitter_onesource(cat, line, data_ALL, Modelsdict, args.resume)
             else:
-                RUN_AGNfitter_multiprocessing(cat, args.ncpu, data_ALL, Modelsdict)
+                RUN_AGNfitter_multiprocessing(cat, args.ncpu, data_ALL, Modelsdict, args.resume)
         
         
     print '======= : ======='
@@ -8,6 +8,7 @@ from emcee.mh import *
 from emcee.ensemble import *
 from emcee.ptsampler import *
 from emcee import utils
+from emcee import backends
 
 
 __version__ = "1.2.0"
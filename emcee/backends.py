@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Backends storing the chain of a sampler somewhere else than in memory.
+
+"""
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+__all__ = ["ChainFile"]
+
+import struct
+import numpy as np
+
+# Size of the header of the ``.npy`` files written by ``ChainFile``, fixed
+# so that it can be rewritten in place when steps are appended.
+HEADER_SIZE = 128
+
+
+class ChainFile(object):
+    """
+    A chain backend for :class:`EnsembleSampler` (its ``backend`` parameter)
+    that appends the stored steps to ``filename + '.chain.npy'`` and
+    ``filename + '.lnprob.npy'``, keeping only the last ``window`` steps in
+    memory. :attr:`chain` and :attr:`lnprobability` are memory-mapped views.
+
+    :param filename:
+        The path of the files, without their extensions.
+
+    :param window: (optional)
+        The number of steps kept in memory before they are written.
+        (default: ``100``)
+
+    :param dtype: (optional)
+        The data type of the files. (default: ``numpy.float64``)
+
+    """
+    def __init__(self, filename, window=100, dtype=np.float64):
+        self.filename = filename
+        self.window = int(window)
+        self.dtype = np.dtype(dtype)
+        self._n = 0
+
+    @property
+    def chainfile(self):
+        return self.filename + ".chain.npy"
+
+    @property
+    def lnprobfile(self):
+        return self.filename + ".lnprob.npy"
+
+    def reset(self, nwalkers, dim):
+        """
+        Empty the files and allocate the window for ``nwalkers`` walkers
+        in ``dim`` dimensions.
+
+        """
+        for fn in (self.chainfile, self.lnprobfile):
+            open(fn, "wb").close()
+        self.restore(nwalkers, dim, 0)
+
+    def restore(self, nwalkers, dim, nsteps):
+        """
+        Like :func:`reset`, but keep the first ``nsteps`` steps of the
+        files, after which the next steps are appended (e.g. to continue
+        from a checkpoint after the files were written further).
+
+        """
+        self.nwalkers, self.dim = nwalkers, dim
+        self.nsteps = nsteps
+        self._n = 0
+        self._chain = np.empty((self.window, nwalkers, dim), dtype=self.dtype)
+        self._lnprob = np.empty((self.window, nwalkers), dtype=self.dtype)
+        for fn, buf in ((self.chainfile, self._chain),
+                        (self.lnprobfile, self._lnprob)):
+            with open(fn, "r+b") as f:
+                f.write(_npy_header(self.dtype, (nsteps, ) + buf.shape[1:]))
+                f.truncate(HEADER_SIZE + nsteps * buf[0].nbytes)
+
+    def save_step(self, p, lnprob):
+        """
+        Store the positions ``p`` (shape ``(nwalkers, dim)``) and their
+        log-probabilities ``lnprob`` (length ``nwalkers``) as the next step.
+
+        """
+        self._chain[self._n] = p
+        self._lnprob[self._n] = lnprob
+        self._n += 1
+        if self._n == self.window:
+            self.flush()
+
+    def flush(self):
+        """
+        Append the steps in the window to the files.
+
+        """
+        if not self._n:
+            return
+        self.nsteps += self._n
+        for fn, buf in ((self.chainfile, self._chain),
+                        (self.lnprobfile, self._lnprob)):
+            with open(fn, "r+b") as f:
+                f.write(_npy_header(self.dtype,
+                                    (self.nsteps, ) + buf.shape[1:]))
+                f.seek(0, 2)
+                f.write(buf[:self._n].tobytes())
+        self._n = 0
+
+    def transformed(self, filename, transform):
+        """
+        A new ``ChainFile`` at ``filename`` with the same log-probabilities
+        and the chain mapped window by window through ``transform``, from
+        ``(nwalkers, nsteps, dim)`` to ``(nwalkers, nsteps, dim2)``.
+
+        """
+        chain, lnprob = self.chain, self.lnprobability
+        out = ChainFile(filename, self.window, self.dtype)
+        out.reset(chain.shape[0], chain.shape[2])
+        for i in range(0, chain.shape[1], self.window):
+            part = transform(np.array(chain[:, i:i + self.window]))
+            if i == 0:
+                out.reset(chain.shape[0], part.shape[2])
+            for j in range(part.shape[1]):
+                out.save_step(part[:, j], lnprob[:, i + j])
+        out.flush()
+        return out
+
+    @property
+    def chain(self):
+        """
+        The chain stored in the file, memory-mapped, with shape
+        ``(nwalkers, nsteps, dim)``.
+
+        """
+        self.flush()
+        return np.load(self.chainfile, mmap_mode="r").transpose(1, 0, 2)
+
+    @property
+    def lnprobability(self):
+        """
+        The log-probabilities stored in the file, memory-mapped, with shape
+        ``(nwalkers, nsteps)``.
+
+        """
+        self.flush()
+        return np.load(self.lnprobfile, mmap_mode="r").T
+
+
+def _npy_header(dtype, shape):
+    # A version 1.0 ``.npy`` header padded to ``HEADER_SIZE`` bytes.
+    header = "{'descr': %s, 'fortran_order': False, 'shape': %s, }" % (
+        repr(str(np.lib.format.dtype_to_descr(dtype))),
+        repr(tuple(int(n) for n in shape)))
+    return (b"\x93NUMPY\x01\x00" + struct.pack(str("<H"), HEADER_SIZE - 10)
+            + header.ljust(HEADER_SIZE - 11).encode("latin1") + b"\n")
@@ -14,6 +14,7 @@ from __future__ import (division, print_function, absolute_import,
 __all__ = ["EnsembleSampler"]
 
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 try:
@@ -64,7 +65,14 @@ class EnsembleSampler(Sampler):
         The number of threads to use for parallelization. If ``threads == 1``,
         then the ``multiprocessing`` module is not used but if
         ``threads > 1``, then a ``Pool`` object is created and calls to
-        ``lnpostfn`` are run in parallel.
+        ``lnpostfn`` are run in parallel. ``lnpostfn`` and ``args`` are
+        installed once in each process (``_worker_init``) and must not be
+        changed after the sampler is created.
+
+    :param threadpool: (optional)
+        If ``True``, the ``Pool`` created with ``threads > 1`` is a pool of
+        threads of this process instead (``multiprocessing.pool.ThreadPool``).
+        ``lnpostfn`` must then be re-entrant. (default: ``False``)
 
     :param pool: (optional)
         An alternative method of using the parallelized algorithm. If
@@ -73,14 +81,33 @@ class EnsembleSampler(Sampler):
         can be any object with a ``map`` method that follows the same
         calling sequence as the built-in ``map`` function.
 
+    :param vectorize: (optional)
+        If ``True``, ``lnpostfn`` is called once per sub-ensemble with the
+        whole ``(nwalkers, dim)`` array of positions and must return the
+        array of log-probabilities, one per walker. With ``threads > 1``,
+        the sub-ensemble is split in one array of positions per process
+        (or thread).
+        ``pool`` is ignored in this mode and no blobs are collected.
+        (default: ``False``)
+
+    :param backend: (optional)
+        An object storing the chain instead of the in-memory arrays, e.g. a
+        :class:`backends.ChainFile` that streams it to disk.
+        (default: ``None``)
+
     """
     def __init__(self, nwalkers, dim, lnpostfn, a=2.0, args=[], postargs=None,
-                 threads=1, daemon = True ,pool=None, live_dangerously=False):
+                 threads=1, daemon = True ,pool=None, live_dangerously=False,
+                 vectorize=False, threadpool=False, backend=None):
         self.k = nwalkers
+        self.backend = backend
         self.a = a
+        self.vectorize = vectorize
 	self.daemon = True
         self.threads = threads
 	self.pool = pool
+        self._resident = False
+        self._own_pool = False
 	
 
         if postargs is not None:
@@ -99,7 +126,14 @@ class EnsembleSampler(Sampler):
                 "crazy!")
 
         if self.threads > 1 and self.pool is None:
-            self.pool = multiprocessing.Pool(self.threads)
+            if threadpool:
+                self.pool = ThreadPool(self.threads)
+            else:
+                self.pool = multiprocessing.Pool(self.threads,
+                                                 initializer=_worker_init,
+                                                 initargs=(self.lnprobfn,))
+                self._resident = True
+            self._own_pool = True
 	    self.daemon = daemon	
     def reset(self):
         """
@@ -111,10 +145,52 @@ class EnsembleSampler(Sampler):
         self.naccepted = np.zeros(self.k)
         self._chain = np.empty((self.k, 0, self.dim))
         self._lnprob = np.empty((self.k, 0))
+        self._nstored = 0
+        if self.backend is not None:
+            self.backend.reset(self.k, self.dim)
 
         # Initialize list for storing optional metadata blobs.
         self._blobs = []
 
+    def checkpoint(self, p, lnprob=None):
+        """
+        A picklable dictionary of everything needed to continue the sampling
+        later from the positions ``p`` (with log-probabilities ``lnprob``, if
+        known) as if it had not been interrupted (see :func:`restore`).
+
+        """
+        state = dict(p=np.array(p), lnprob=lnprob, rstate=self.random_state,
+                     naccepted=np.array(self.naccepted),
+                     iterations=self.iterations)
+        if lnprob is not None:
+            state["lnprob"] = np.array(lnprob)
+        if self.backend is not None:
+            self.backend.flush()
+            state["nsteps"] = self.backend.nsteps
+        else:
+            state["chain"] = np.array(self._chain[:, :self._nstored])
+            state["lnprobability"] = np.array(
+                self._lnprob[:, :self._nstored])
+        return state
+
+    def restore(self, state):
+        """
+        Restore the sampler to a :func:`checkpoint` and return its positions
+        and log-probabilities (``None`` if unknown), from which
+        :func:`sample` continues.
+
+        """
+        self.random_state = state["rstate"]
+        self.naccepted = np.array(state["naccepted"])
+        self.iterations = state["iterations"]
+        if self.backend is not None:
+            self.backend.restore(self.k, self.dim, state["nsteps"])
+        else:
+            self._chain = np.array(state["chain"])
+            self._lnprob = np.array(state["lnprobability"])
+            self._nstored = self._chain.shape[1]
+        return state["p"], state["lnprob"]
+
     def sample(self, p0, lnprob0=None, rstate0=None, blobs0=None,
                iterations=1, thin=1, storechain=True, mh_proposal=None):
         """
@@ -190,17 +266,18 @@ class EnsembleSampler(Sampler):
         if np.any(np.isnan(lnprob)):
             raise ValueError("The initial lnprob was NaN.")
 
-        # Store the initial size of the stored chain.
-        i0 = self._chain.shape[1]
+        # Store the initial size of the stored chain (without the steps
+        # allocated by a previous call that was stopped early).
+        i0 = self._nstored
 
         # Here, we resize chain in advance for performance. This actually
         # makes a pretty big difference.
-        if storechain:
+        if storechain and self.backend is None:
             N = int(iterations / thin)
-            self._chain = np.concatenate((self._chain,
+            self._chain = np.concatenate((self._chain[:, :i0],
                                           np.zeros((self.k, N, self.dim))),
                                          axis=1)
-            self._lnprob = np.concatenate((self._lnprob,
+            self._lnprob = np.concatenate((self._lnprob[:, :i0],
                                            np.zeros((self.k, N))), axis=1)
 
         for i in range(int(iterations)):
@@ -263,9 +340,13 @@ class EnsembleSampler(Sampler):
                                 blobs[indfull[j]] = blob[ind[j]]
 
             if storechain and i % thin == 0:
-                ind = i0 + int(i / thin)
-                self._chain[:, ind, :] = p
-                self._lnprob[:, ind] = lnprob
+                if self.backend is not None:
+                    self.backend.save_step(p, lnprob)
+                else:
+                    ind = i0 + int(i / thin)
+                    self._chain[:, ind, :] = p
+                    self._lnprob[:, ind] = lnprob
+                    self._nstored = ind + 1
                 if blobs is not None:
                     self._blobs.append(list(blobs))
 
@@ -353,6 +434,24 @@ class EnsembleSampler(Sampler):
         if np.any(np.isnan(p)):
             raise ValueError("At least one parameter value was NaN.")
 
+        # The processes of the pool created with ``threads > 1`` already
+        # have ``lnprobfn``, the threads share it.
+        f = _worker_lnprob if self._resident else self.lnprobfn
+
+        # A vectorized ``lnpostfn`` evaluates the whole sub-ensemble in a
+        # single call (or one call per process or thread of the pool).
+        if self.vectorize:
+            if self._own_pool:
+                chunks = [c for c in np.array_split(p, self.threads) if len(c)]
+                lnprob = np.concatenate([np.atleast_1d(l) for l in
+                                         self.pool.map(f, chunks)])
+            else:
+                lnprob = self.lnprobfn(p)
+            lnprob = np.array(lnprob, dtype=float).reshape(len(p))
+            if np.any(np.isnan(lnprob)):
+                raise ValueError("lnprob returned NaN.")
+            return lnprob, None
+
         # If the `pool` property of the sampler has been set (i.e. we want
         # to use `multiprocessing`), use the `pool`'s map method. Otherwise,
         # just use the built-in `map` function.
@@ -362,7 +461,7 @@ class EnsembleSampler(Sampler):
             M = map
 
         # Run the log-probability calculations (optionally in parallel).
-        results = list(M(self.lnprobfn, [p[i] for i in range(len(p))]))
+        results = list(M(f, [p[i] for i in range(len(p))]))
 
         try:
             lnprob = np.array([float(l[0]) for l in results])
@@ -392,10 +491,13 @@ class EnsembleSampler(Sampler):
     def chain(self):
         """
         A pointer to the Markov chain itself. The shape of this array is
-        ``(k, iterations, dim)``.
+        ``(k, iterations, dim)``, with only the steps stored so far (e.g.
+        while :func:`sample` runs, or if it was stopped early).
 
         """
-        return super(EnsembleSampler, self).chain
+        if self.backend is not None:
+            return self.backend.chain
+        return super(EnsembleSampler, self).chain[:, :self._nstored]
 
     @property
     def flatchain(self):
@@ -414,7 +516,9 @@ class EnsembleSampler(Sampler):
         step for each walker. The shape is ``(k, iterations)``.
 
         """
-        return super(EnsembleSampler, self).lnprobability
+        if self.backend is not None:
+            return self.backend.lnprobability
+        return super(EnsembleSampler, self).lnprobability[:, :self._nstored]
 
     @property
     def flatlnprobability(self):
@@ -423,7 +527,7 @@ class EnsembleSampler(Sampler):
         to ``flatchain`` rather than ``chain``.
 
         """
-        return super(EnsembleSampler, self).lnprobability.flatten()
+        return self.lnprobability.flatten()
 
     @property
     def acceptance_fraction(self):
@@ -450,6 +554,26 @@ class EnsembleSampler(Sampler):
         return t
 
 
+def _worker_init(lnprobfn):
+    """
+    Initializer of the processes of the pool created with ``threads > 1``:
+    installs the log-probability function, with its ``args``, once in each
+    process.
+
+    """
+    global _worker_lnprobfn
+    _worker_lnprobfn = lnprobfn
+
+
+def _worker_lnprob(x):
+    """
+    The log-probability at ``x``, in a process of the pool created with
+    ``threads > 1`` (see ``_worker_init``).
+
+    """
+    return _worker_lnprobfn(x)
+
+
 class _function_wrapper(object):
     """
     This is a hack to make the likelihood function pickleable when ``args``
@@ -5,11 +5,16 @@ Defines various nose unit tests
 
 """
 
+import os
+import shutil
+import tempfile
+
 import numpy as np
 
 from .mh import MHSampler
 from .ensemble import EnsembleSampler
 from .ptsampler import PTSampler
+from .backends import ChainFile
 
 logprecision = -4
 
@@ -28,6 +33,10 @@ def lnprob_gaussian_nan(x, icov):
     return result
 
 
+def lnprob_gaussian_vectorized(x, icov):
+    return -np.sum(x * np.dot(x, icov), axis=1) / 2.0
+
+
 def log_unit_sphere_volume(ndim):
     if ndim % 2 == 0:
         logfactorial = 0.0
@@ -152,6 +161,12 @@ class Tests:
                                        lnprob_gaussian, args=[self.icov])
         self.check_sampler()
 
+    def test_vectorize(self):
+        self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
+                                       lnprob_gaussian_vectorized,
+                                       args=[self.icov], vectorize=True)
+        self.check_sampler()
+
     def test_nan_lnprob(self):
         self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
                                        lnprob_gaussian_nan,
@@ -213,11 +228,109 @@ class Tests:
         else:
             assert False, "The sampler should have failed by now."
 
-    # def test_parallel(self):
-    #     self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
-    #                                    lnprob_gaussian, args=[self.icov],
-    #                                    threads=2)
-    #     self.check_sampler()
+    def test_parallel(self):
+        self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
+                                       lnprob_gaussian, args=[self.icov],
+                                       threads=2)
+        self.check_sampler()
+        self.sampler.pool.terminate()
+
+    def test_parallel_vectorize(self):
+        self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
+                                       lnprob_gaussian_vectorized,
+                                       args=[self.icov], threads=3,
+                                       vectorize=True)
+        self.check_sampler()
+        self.sampler.pool.terminate()
+
+    def test_threadpool(self):
+        self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
+                                       lnprob_gaussian_vectorized,
+                                       args=[self.icov], threads=2,
+                                       vectorize=True, threadpool=True)
+        self.check_sampler()
+        self.sampler.pool.terminate()
+
+    def test_chainfile(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, "samples")
+            self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
+                                           lnprob_gaussian, args=[self.icov],
+                                           backend=ChainFile(filename, 64))
+            self.check_sampler()
+            assert self.sampler.chain.shape == (self.nwalkers, self.N,
+                                                self.ndim)
+
+            # The streamed chain is the one kept in memory, and can be
+            # read back from the files.
+            rstate = np.random.RandomState(0).get_state()
+            memory = EnsembleSampler(self.nwalkers, self.ndim,
+                                     lnprob_gaussian, args=[self.icov])
+            for sampler in (self.sampler, memory):
+                sampler.reset()
+                for i in sampler.sample(self.p0, rstate0=rstate,
+                                        iterations=99, thin=3):
+                    pass
+            stored = ChainFile(filename)
+            for chain, lnprob in ((self.sampler.chain,
+                                   self.sampler.lnprobability),
+                                  (stored.chain, stored.lnprobability)):
+                assert np.all(chain == memory.chain)
+                assert np.all(lnprob == memory.lnprobability)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_checkpoint(self):
+        folder = tempfile.mkdtemp()
+        try:
+            rstate = np.random.RandomState(0).get_state()
+            full = EnsembleSampler(self.nwalkers, self.ndim, lnprob_gaussian,
+                                   args=[self.icov])
+            for i in full.sample(self.p0, rstate0=rstate, iterations=100):
+                pass
+
+            for filename in (None, os.path.join(folder, "samples")):
+                # Interrupt a sampler after a checkpoint, and continue from
+                # it with another one (on the same files).
+                first, second = [EnsembleSampler(
+                    self.nwalkers, self.ndim, lnprob_gaussian,
+                    args=[self.icov]) for i in range(2)]
+                if filename is not None:
+                    for sampler in (first, second):
+                        sampler.backend = ChainFile(filename, 16)
+                    first.reset()
+                for i, (p, lnprob, state) in enumerate(
+                        first.sample(self.p0, rstate0=rstate, iterations=100)):
+                    if i == 39:
+                        checkpoint = first.checkpoint(p, lnprob)
+                    elif i == 49:
+                        break
+                p, lnprob = second.restore(checkpoint)
+                for i in second.sample(p, lnprob, iterations=60):
+                    pass
+
+                assert np.all(second.chain == full.chain)
+                assert np.all(second.lnprobability == full.lnprobability)
+                assert np.all(second.naccepted == full.naccepted)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_stopped_early(self):
+        self.sampler = EnsembleSampler(self.nwalkers, self.ndim,
+                                       lnprob_gaussian, args=[self.icov])
+        for i, (p, lnprob, state) in enumerate(
+                self.sampler.sample(self.p0, iterations=100)):
+            if i == 29:
+                break
+        assert self.sampler.chain.shape == (self.nwalkers, 30, self.ndim)
+
+        # Continuing appends to the steps stored so far.
+        for i in self.sampler.sample(p, lnprob, iterations=20):
+            pass
+        assert self.sampler.chain.shape == (self.nwalkers, 50, self.ndim)
+        assert self.sampler.lnprobability.shape == (self.nwalkers, 50)
+        assert np.all(self.sampler.chain[:, 29] != 0)
 
     def test_pt_sampler(self):
         cutoff = 10.0
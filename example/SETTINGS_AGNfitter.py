@@ -93,6 +93,20 @@ def FILTERS_settings():
     filters = dict()
 
     filters['dict_zarray'] =np.array([0.283, 1.58])  # The grid of redshifts needed to fit your catalog
+    filters['z_interpolation'] = False  # True to interpolate the model fluxes between the two redshifts of dict_zarray 
+                                        # which bracket each source, instead of taking the nearest one, for a coarse grid 
+                                        # (e.g. spacing 0.02)
+    filters['float32'] = False  # True to store the model dictionary, and the chains, in single precision 
+                                # (half the memory, compare first with RUN_AGNfitter_multi.py --precision)
+    filters['ebv_polynomial'] = 0  # Degree (e.g. 3) of polynomials in E(B-V) fitted to the galaxy and BBB fluxes, to fit
+                                   # with continuous E(B-V) instead of the nearest of the grid; 0 to use the grid
+                                   # (raised at each redshift until the fluxes agree to 1e-3 with those of the grid;
+                                   # fitted when the dictionary is built or updated, and stored instead of the grid)
+    filters['galaxy_svd'] = 0  # Tolerance (e.g. 1e-6) to store the galaxy templates of a new model dictionary on a 
+                               # truncated SVD basis (several times smaller), 0 to store them in full 
+                               # (see DICTIONARIES_AGNfitter.svd_basis)
+    filters['dict_sharded'] = False  # True to store a new model dictionary as a directory with one slice per redshift,
+                                     # loaded only when needed (memory-mapped, shared by the processes)
     filters['Bandset'] = 'BANDSET_default' # OPTIONS: 
                                            # 'BANDSET_default' (for testing)
                                            # 'BANDSET_settings' (choosing relevant filters below, as given by your catalog)
@@ -164,6 +178,34 @@ def MCMC_settings():
     mc['Nburn'] = 4000 ## length of each burn-in sets
     mc['Nmcmc'] = 10000  ## length of each burn-in sets
     mc['iprint'] = 1000 ## show progress in terminal in steps of this many samples
+    mc['vectorize'] = False ## True evaluates the posterior of all walkers in one call (faster).
+                            ## False evaluates walker by walker.
+    mc['threads'] = 1 ## number of processes sharing the posterior evaluations of one source (for a bright
+                      ## source run alone, with -n; the sources of the catalog are shared by --ncpu, whose
+                      ## processes cannot have their own, so there they are threads as with threadpool).
+    mc['threadpool'] = False ## True to share them among threads instead of processes, which share the model
+                             ## dictionary without copies (in parallel where NumPy releases the GIL).
+    mc['chain_window'] = 0 ## if > 0, the chains are streamed to .npy files next to the .sav files, keeping 
+                           ## only this many steps in memory (for long chains). 0 keeps them in memory.
+    mc['checkpoint'] = 0 ## if > 0, save a checkpoint of the sampling every this many steps, into checkpoint.sav in the 
+                         ## output folder of the source, to continue a run killed meanwhile with --resume. 0 for none.
+    mc['acor_every'] = 0 ## if > 0, estimate the autocorrelation time tau of the MCMC chains every this many steps,
+                         ## and stop before Nmcmc steps once they are longer than acor_factor x tau, with tau
+                         ## changed by less than the fraction acor_tolerance since the previous estimate
+                         ## (the reason of the stop is written in the output). 0 always runs Nmcmc steps.
+    mc['acor_factor'] = 50
+    mc['acor_tolerance'] = 0.01
+    mc['marginalise_amplitudes'] = False ## sample only the 6 template parameters, and fit the amplitudes 
+                                         ## SB, BB, GA, TO for each of them (shorter burn-in).
+    mc['engine'] = 'emcee' ## 'emcee' for the MCMC sampling, or 'grid' to fit all combinations of templates
+                           ## of the model grids (GRID_AGNfitter.py), with the amplitudes fitted linearly.
+                           ## The grid posterior is saved as grid_draws draws, as the MCMC chains.
+                           ## 'catalog' to fit the whole catalog on the grid, with the sources
+                           ## grouped by redshift, into one table of best fits and percentiles.
+    mc['grid_thinning'] = dict(tau=1, age=1, Nh=1, irlum=1, EBVbbb=1, EBVgal=1) ## for 'grid' and 'catalog': use every n-th 
+                                                                                ## value of each parameter grid (1: all).
+    mc['grid_draws'] = 10000 ## for 'grid': number of independent draws of the posterior saved as the chains.
+    mc['grid_seed'] = 0 ## for 'grid': seed of the draws, for reproducible outputs.
 
     return mc
 
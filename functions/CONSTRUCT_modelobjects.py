@@ -1,5 +1,6 @@
 import numpy as np
 import math
+import os
 
 import time
 import cPickle
@@ -146,8 +147,8 @@ class MODEL:
 
         if self.component== 'galaxy':
 
-            #self.wave,self.tau, self.tg,self.SED, self.SFR = cPickle.load(file(self.path + 'models/GALAXY/bc03_275templates_files.pickle', 'rb')) 
-            self.wave,self.tau, self.tg,self.SED, self.SFR = cPickle.load(file(self.path + 'models/GALAXY/bc03_840templates_files.pickle', 'rb')) 
+            self.wave,self.tau, self.tg,self.SED, self.SFR = cPickle.load(file(self.path + 'models/GALAXY/bc03_275templates_files.pickle', 'rb')) 
+            #self.wave,self.tau, self.tg,self.SED, self.SFR = cPickle.load(file(self.path + 'models/GALAXY/bc03_840templates_files.pickle', 'rb')) 
 
 
         if self.component== 'torus':
@@ -177,35 +178,24 @@ def construct(path):
 
     """
     saves objects of class MODEL, into pickle files.
+    Only the pickle files which are missing, or older than the files
+    they are built from, are written (not at every dictionary construction).
+    Models whose original files are not available keep their pickle file.
     """
 
-    SB = MODEL('starburst', path)
-    SB.build()
-    f = open(path + 'models/STARBURST/dalehelou_charyelbaz_v1.pickle', 'wb')
-    cPickle.dump(SB, f, protocol=2)
-    f.close()
-
-
-    TO = MODEL('torus', path)
-    TO.build()
-    f1 = open(path + 'models/TORUS/silva_v1.pickle', 'wb')
-    cPickle.dump(TO, f1, protocol=2)
-    f1.close()
-
-    BB = MODEL('bbb', path)
-    BB.build()
-    f2 = open(path + 'models/BBB/richards.pickle', 'wb')
-    cPickle.dump(BB, f2, protocol=2)
-    f2.close()
-
-
-    GA = MODEL('galaxy', path)
-    GA.build()
-    #f2 = open(path + 'models/GALAXY/bc03_275templates.pickle', 'wb')
-    f2 = open(path + 'models/GALAXY/bc03_840templates.pickle', 'wb')
-    cPickle.dump(GA, f2, protocol=2)
-    f2.close()
-
-
-
-
+    for component, files, pickled in (('starburst', 'models/STARBURST/dalehelou_charyelbaz_files.npz', 'models/STARBURST/dalehelou_charyelbaz_v1.pickle'),
+                                      ('torus', 'models/TORUS/silva_v1_files.npz', 'models/TORUS/silva_v1.pickle'),
+                                      ('bbb', 'models/BBB/richards_files.npz', 'models/BBB/richards.pickle'),
+                                      ('galaxy', 'models/GALAXY/bc03_275templates_files.pickle', 'models/GALAXY/bc03_275templates.pickle')):
+
+        if not os.path.exists(path + files):
+            print 'Warning: %s not found, keeping %s as it is.' % (files, pickled)
+            continue
+        if os.path.exists(path + pickled) and os.path.getmtime(path + pickled) >= os.path.getmtime(path + files):
+            continue
+
+        MO = MODEL(component, path)
+        MO.build()
+        f = open(path + pickled, 'wb')
+        cPickle.dump(MO, f, protocol=2)
+        f.close()
@@ -23,6 +23,7 @@ from astropy.io import fits
 import cPickle
 import functions.MODEL_AGNfitter as model
 import functions.DICTIONARIES_AGNfitter as dicts
+import functions.PARAMETERSPACE_AGNfitter as parspace
 
 
 
@@ -267,6 +268,9 @@ class DATA():
         self.z =catalog.z[line]
         self.dlum = catalog.dlum[line]
 
+        # likelihood terms which only depend on the data of this source
+        self.lnlike = parspace.LIKELIHOOD_KERNEL(self.nus, self.fluxes, self.fluxerrs, self.z)
+
         self.cat = catalog.cat
         #self.sourceline = sourceline
         self.catalog = catalog.cat['filename']
@@ -283,17 +287,25 @@ class DATA():
         corresponding to the redshift of the source
         """
 
-        z_array = np.array(list(Modelsdict.keys()))
+        z_array = dicts.redshift_keys(Modelsdict)
         idx = (np.abs(z_array.astype(float)-self.z)).argmin()
         z_key = z_array[idx] 
 
         self.filterdict = dicts.filter_dictionaries(filters['Bandset'], self.path, filters)   
-        self.dict_modelfluxes = Modelsdict[z_key]
+        float32, degree = filters.get('float32', False), filters.get('ebv_polynomial', 0)
+        if filters.get('z_interpolation', False):
+            self.dict_modelfluxes = dicts.modelsdict_interpolated(Modelsdict, self.z, self.filterdict[0], float32, degree)
+        else:
+            self.dict_modelfluxes = dicts.modelsdict_z(Modelsdict[z_key], self.filterdict[0], float32, degree)
         self.dictkey_arrays = dicts.dictkey_arrays(self.dict_modelfluxes)
+        # spectra over the whole wavelength range, for plotting, shared by all redshifts
+        self.library = dicts.restframe_library(Modelsdict, z_key, float32)
         
         print 'Filter set contains {:d} bands'.format(len(self.filterdict[0]))
-        m = Modelsdict[z_key]
-        bands = m[0][m[0].keys()[0]][0]
+        bands = self.dict_modelfluxes['bands']
         print 'Model sets contains {:d} bands'.format(len(bands))
+
+        # prior on the galaxy luminosity, which only depends on this source and the bands
+        self.lumfct_prior = parspace.GALAXY_LUMFCT_PRIOR(self.z, self.dlum, bands)
         
         
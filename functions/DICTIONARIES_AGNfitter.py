@@ -17,16 +17,22 @@ This script contains all functions which are needed to construct the total model
 import numpy as np
 import sys
 import os
-from collections import defaultdict
+import shutil
+from collections import defaultdict, OrderedDict
 
 import MODEL_AGNfitter as model
 from scipy.integrate  import trapz
-import time
 import cPickle
 import shelve
+import multiprocessing as mp
 from astropy import units as u 
 
 
+#Key of the rest-frame spectral library (MODELSDICT.construct_library) in the 
+#dictionary of models, whose other keys are the redshifts.
+LIBRARY = 'restframe_library'
+
+
 class MODELSDICT:
 
 
@@ -53,10 +59,22 @@ class MODELSDICT:
         self.z_array = filters['dict_zarray']
         self.filterset = filters['Bandset']
         self.filters = filters
+        # filter curves, source templates and rest-frame library, constructed
+        # once by prepare (before the processes are started, which inherit them)
+        self.filterdict = None
+        self.templates = None
+        self.library = None
 
-    def build(self, save=True):
+    def build(self, save=True, processes=1):
 
-        COSMOS_modelsdict = dict()
+        """
+        Constructs the dictionaries of all redshifts of self.z_array, and saves them
+        into self.filename (or returns them, with save=False).
+        With processes > 1, the redshifts are shared among a pool of processes.
+        The rest-frame spectral library is stored once, under the key LIBRARY.
+        With filters['dict_sharded'], self.filename is a directory with one slice
+        per redshift, written as soon as it is constructed (SHARDED_MODELSDICT).
+        """
 
         print 'MODELSDICT.build'
         print 'Constructing Dictionary of models.' 
@@ -68,21 +86,38 @@ class MODELSDICT:
         print 'If you interrupt it, please trash the empty file created.'
         print ''
 
+        self.prepare()
+
         i=0
         dictionary_progressbar(i, len(self.z_array), prefix = 'Dict:', suffix = 'Complete', barLength = 50)
-    
-        for z in self.z_array:                
-            i += 1
-            filterdict = filter_dictionaries(self.filterset, self.path, self.filters)
-            dict_modelsfiltered = self.construct_dictionaryarray_filtered(z, filterdict, self.path)
-            COSMOS_modelsdict[str(z)] = dict_modelsfiltered
 
-            time.sleep(0.01)
-            dictionary_progressbar(i, len(self.z_array), prefix = 'Dict:', suffix = 'Complete', barLength = 50)
+        if processes > 1:
+            pool = mp.Pool(processes=processes, initializer=_build_worker_init, initargs=(self,))
+            results = pool.imap_unordered(_build_worker, self.z_array)
+        else:
+            results = (self.construct_z(z) for z in self.z_array)
 
+        shards = SHARDED_MODELSDICT(self.filename) if save and self.filters.get('dict_sharded', False) else None
+        COSMOS_modelsdict = dict()
+        for z_key, dict_modelsfiltered in results:
+            i += 1
+            if shards is not None:
+                shards[z_key] = dict_modelsfiltered
+            else:
+                COSMOS_modelsdict[z_key] = dict_modelsfiltered
+            dictionary_progressbar(i, len(self.z_array), prefix = 'Dict:', suffix = 'Complete', barLength = 50)
 
+        if processes > 1:
+            pool.close()
+            pool.join()
 
         print 'Dictionary has been created in :', self.filename
+
+        if shards is not None:
+            shards[LIBRARY] = self.construct_library_stored()
+            return
+
+        COSMOS_modelsdict[LIBRARY] = self.construct_library_stored()
         
         if save:
 
@@ -95,150 +130,980 @@ class MODELSDICT:
         else:
             return COSMOS_modelsdict
 
+    def prepare(self):
 
+        """
+        Reads the filter curves and constructs the rest-frame library (with the
+        source templates), if not done yet. Called before starting the processes
+        of build and update, so that they share them instead of reading them again.
+        """
 
-    def construct_dictionaryarray_filtered(self, z, filterdict,path):
+        if self.filterdict is None:
+            self.filterdict = filter_dictionaries(self.filterset, self.path, self.filters)
+        self.construct_library(self.path)
+
+    def construct_z(self, z, bands=None):
 
         """
-        Construct the dictionaries of fluxes at bands (to compare to data), 
-        and dictionaries of fluxes over the whole spectrum, for plotting.
+        Constructs the dictionary of models of redshift z (construct_dictionaryarray_filtered),
+        with the galaxy and BBB fluxes as polynomials in E(B-V) if filters['ebv_polynomial']
+        (ebv_polynomial), and in single precision if filters['float32'].
+        If given, only for the bands (central frequencies) of the filter set in bands
+        (merged with merge_bands, which fits the polynomials).
+        Returns the key of the redshift and the dictionary.
         """
 
-        GALAXYFdict_filtered = dict()
-        GALAXY_SFRdict = dict()
-        STARBURSTFdict_filtered = dict()        
-        BBBFdict_filtered = dict()
-        TORUSFdict_filtered = dict()
+        self.prepare()
+        filterdict = self.filterdict
+        if bands is not None:
+            filterdict = (np.asarray(bands),) + tuple(filterdict[1:])
+        dict_modelsfiltered = self.construct_dictionaryarray_filtered(z, filterdict, self.path)
+        if bands is None:
+            #the new bands alone may miss the templates, checked once merged (merge_bands)
+            check_fluxes(dict_modelsfiltered)
+            degree = self.filters.get('ebv_polynomial', 0)
+            if degree:
+                dict_modelsfiltered = ebv_polynomial(svd_fluxes(dict_modelsfiltered), degree)
+        if self.filters.get('float32', False):
+            dict_modelsfiltered = single_precision(dict_modelsfiltered)
+
+        return str(z), dict_modelsfiltered
+
+    def construct_library_stored(self):
+
+        """
+        The rest-frame spectral library (construct_library), in single precision 
+        if filters['float32'], as stored under the key LIBRARY.
+        """
+
+        library = self.construct_library(self.path)
+        if self.filters.get('float32', False):
+            library = single_precision(library)
+
+        return library
+
+    def update(self, Modelsdict, processes=1):
+
+        """
+        Completes the dictionary Modelsdict, loaded from self.filename, with the redshifts,
+        bands (merge_bands) and rest-frame library it does not contain, converted to polynomials
+        in E(B-V) with filters['ebv_polynomial'], and saves it into self.filename.
+        Returns the number of redshifts constructed, completed or converted (0 if nothing was missing).
+        """
+
+        if self.filterdict is None:
+            self.filterdict = filter_dictionaries(self.filterset, self.path, self.filters)
+        bands = self.filterdict[0]
+
+        tasks = []
+        converted = 0
+        degree = self.filters.get('ebv_polynomial', 0)
+        if LIBRARY not in Modelsdict:
+            tasks.append(LIBRARY)
+        for z in self.z_array:
+            if str(z) not in Modelsdict:
+                tasks.append((z, None))
+                continue
+            if isinstance(Modelsdict[str(z)], tuple):
+                Modelsdict[str(z)] = dictarrays_from_dicts(Modelsdict[str(z)])
+            if degree and 'ebv_polynomial' not in Modelsdict[str(z)]:
+                Modelsdict[str(z)] = ebv_polynomial(svd_fluxes(Modelsdict[str(z)]), degree)
+                converted += 1
+            missing = np.setdiff1d(bands, Modelsdict[str(z)]['bands'])
+            if len(missing):
+                tasks.append((Modelsdict[str(z)].get('z', z), missing))
+        if not tasks and not converted:
+            return 0
+
+        print 'MODELSDICT.update'
+        print 'Completing the dictionary of models', self.filename
+        print '%i new redshifts, %i redshifts with new bands, %i converted to polynomials in E(B-V)' % (
+            sum(1 for t in tasks if t != LIBRARY and t[1] is None), 
+            sum(1 for t in tasks if t != LIBRARY and t[1] is not None), converted)
+
+        if tasks:
+            self.prepare()
+
+            i = 0
+            dictionary_progressbar(i, len(tasks), prefix = 'Dict:', suffix = 'Complete', barLength = 50)
+
+            if processes > 1:
+                pool = mp.Pool(processes=processes, initializer=_build_worker_init, initargs=(self,))
+                results = pool.imap_unordered(_build_worker, tasks)
+            else:
+                results = (_build_task(self, task) for task in tasks)
+
+            for z_key, new in results:
+                i += 1
+                if z_key == LIBRARY:
+                    #the per-redshift spectra of the former dictionaries are not needed anymore
+                    for key in Modelsdict:
+                        if key != LIBRARY and not isinstance(Modelsdict[key], tuple):
+                            Modelsdict[key] = dict((k, v) for k, v in Modelsdict[key].items() if not k.endswith('_4plot'))
+                    Modelsdict[z_key] = new
+                elif z_key in Modelsdict:
+                    Modelsdict[z_key] = merge_bands(Modelsdict[z_key], new)
+                else:
+                    Modelsdict[z_key] = new
+                dictionary_progressbar(i, len(tasks), prefix = 'Dict:', suffix = 'Complete', barLength = 50)
+
+            if processes > 1:
+                pool.close()
+                pool.join()
+
+        if not isinstance(Modelsdict, SHARDED_MODELSDICT):
+            with open(self.filename, 'wb') as f:
+                print 'Saving dict to : ',self.filename
+                cPickle.dump(Modelsdict, f, protocol=2)
+                print 'done'
+
+        return len(tasks) + converted
 
-        GALAXYFdict_4plot = dict()
-        STARBURSTFdict_4plot = dict()        
-        BBBFdict_4plot = dict()
-        TORUSFdict_4plot = dict()
+    def template_library(self, path):
 
+        """
+        Source templates of the four model families (TEMPLATE_LIBRARY), read 
+        and preprocessed once.
+        """
 
+        if self.templates is None:
+            self.templates = TEMPLATE_LIBRARY(path)
+        return self.templates
 
-        #OPENING TEMPLATES AND BUILDING DICTIONARIES
 
+    def construct_library(self, path):
 
-        #Call object containing all galaxy models     
-        galaxy_object = cPickle.load(file(path + 'models/GALAXY/bc03_275templates.pickle', 'rb')) 
-        _, ageidx, tauidx, _, _,_ =  np.shape(galaxy_object.SED)
-        #Construct dictionaries 
-        for taui in range(tauidx):
-            for agei in range(ageidx):
-                t1= time.time()
-                gal_wl, gal_Fwl =  galaxy_object.wave, galaxy_object.SED[:,agei,taui,:,:,:].squeeze()
-                gal_nus= gal_wl.to(u.Hz, equivalencies=u.spectral())[::-1]#invert
-                gal_Fnu= (gal_Fwl * 3.34e-19 * gal_wl**2.)[::-1]  
-                gal_SFR= galaxy_object.SFR[:,agei,taui,:,:].squeeze()
-                GALAXY_SFRdict[str(galaxy_object.tau.value[taui]),str(galaxy_object.tg.value[agei])] = gal_SFR
+        """
+        Construct the rest-frame spectral library, stored once under the key LIBRARY:
+        the parameter grids and the spectra for plotting, 'GALAXY_4plot' (nus, [tau, age, ebvgal, nus]),
+        'STARBURST_4plot' [(nus, Fnus) for irlum], 'TORUS_4plot' ([nus for nh], [nh, nus]),
+        'BBB_4plot' (nus, [ebvbbb, nus]).
+
+        With filters['galaxy_svd'], the galaxy spectra are stored instead on a truncated
+        SVD basis (svd_basis), 'GALAXY_svd' [tau, age, k] and 'GALAXY_4plot_basis'
+        (nus, [ebvgal, k, nus]), reddened at each E(B-V) (galaxy_4plot).
+        """
 
-                for EBV_gal in self.ebvgal_array:
-                    #Apply reddening            
-                    gal_nu, gal_Fnu_red = model.GALAXYred_Calzetti(gal_nus.value[0:len(gal_nus):3], gal_Fnu.value[0:len(gal_nus):3], EBV_gal)                    
-                    GALAXYFdict_4plot[str(galaxy_object.tau.value[taui]),str(galaxy_object.tg.value[agei]), str(EBV_gal)] = \
-                                                                                            np.log10(gal_nu), gal_Fnu_red
-                    #Projection of filter curves on models
-                    bands,  gal_Fnu_filtered =  model.filters1(np.log10(gal_nu), gal_Fnu_red, filterdict, z)            
-                    GALAXYFdict_filtered[str(galaxy_object.tau.value[taui]),str(galaxy_object.tg.value[agei]), str(EBV_gal)] = \
-                                                                                                        bands, gal_Fnu_filtered
-        #Call object containing all starburst models     
-        starburst_object = cPickle.load(file(path + 'models/STARBURST/dalehelou_charyelbaz_v1.pickle', 'rb')) 
-        irlumidx = len(starburst_object.SED)
-        #Construct dictionaries 
-        for irlumi in range(irlumidx):
-            sb_nu0, sb_Fnu0 = starburst_object.wave[irlumi], starburst_object.SED[irlumi].squeeze()
-            STARBURSTFdict_4plot[str(starburst_object.irlum[irlumi])] = sb_nu0, sb_Fnu0
-            bands, sb_Fnu_filtered = model.filters1(sb_nu0, sb_Fnu0, filterdict, z)
-            STARBURSTFdict_filtered[str(starburst_object.irlum[irlumi])] = bands, sb_Fnu_filtered
-            if np.amax(sb_Fnu_filtered) == 0:
-                print 'Error: something is wrong in the calculation of STARBURST flux'
+        if self.library is not None:
+            return self.library
 
+        templates = self.template_library(path)
+        library = dict()
 
+        library['tau'] = templates.tau
+        library['age'] = templates.age
+        library['ebvgal'] = np.array(self.ebvgal_array)
+        library['GALAXY_SFR'] = templates.gal_SFR
 
-        #No object to call since bbb is only one model     
-        bbb_object = cPickle.load(file(path + 'models/BBB/richards.pickle', 'rb')) 
+        tolerance = self.filters.get('galaxy_svd', 0)
+        if tolerance:
+            library['GALAXY_svd'], basis = svd_basis(templates.gal_Fnu, tolerance)
+            GALAXY_4plot_basis = np.zeros((len(self.ebvgal_array),) + basis.shape)
+            for ebvi, EBV_gal in enumerate(self.ebvgal_array):
+                gal_nu, GALAXY_4plot_basis[ebvi] = model.GALAXYred_Calzetti(templates.gal_nu, basis, EBV_gal)
+            library['GALAXY_4plot_basis'] = np.log10(templates.gal_nu), GALAXY_4plot_basis
+        else:
+            #Galaxy: reddening applied to all tau, age at once
+            GALAXY_4plot = np.zeros(templates.gal_Fnu.shape[:2] + (len(self.ebvgal_array),) + templates.gal_Fnu.shape[2:])
+            for ebvi, EBV_gal in enumerate(self.ebvgal_array):
+                gal_nu, GALAXY_4plot[:, :, ebvi] = model.GALAXYred_Calzetti(templates.gal_nu, templates.gal_Fnu, EBV_gal)
+            library['GALAXY_4plot'] = np.log10(templates.gal_nu), GALAXY_4plot
 
-        bbb_nu, bbb_Fnu = bbb_object.wave, bbb_object.SED.squeeze()
-        #Construct dictionaries
-        for EBV_bbb in self.ebvbbb_array:
-            bbb_nu0, bbb_Fnu_red = model.BBBred_Prevot(bbb_nu, bbb_Fnu, EBV_bbb, z )
-            BBBFdict_4plot[str(EBV_bbb)] =bbb_nu0, bbb_Fnu_red
-            bands, bbb_Fnu_filtered = model.filters1(bbb_nu0, bbb_Fnu_red, filterdict,z)
-            BBBFdict_filtered[str(EBV_bbb)] = bands, bbb_Fnu_filtered
-            if np.amax(bbb_Fnu_filtered) == 0:
-                print 'Error: something is wrong in the calculation of BBB flux'            
+        library['irlum'] = templates.irlum
+        library['STARBURST_4plot'] = zip(templates.sb_nu, templates.sb_Fnu)
 
+        BBB_4plot = np.zeros((len(self.ebvbbb_array), len(templates.bbb_nu)))
+        for ebvi, EBV_bbb in enumerate(self.ebvbbb_array):
+            #The reddening law does not depend on the redshift
+            bbb_nu0, BBB_4plot[ebvi] = model.BBBred_Prevot(templates.bbb_nu, templates.bbb_Fnu, EBV_bbb, None)
 
+        library['ebvbbb'] = np.array(self.ebvbbb_array)
+        library['BBB_4plot'] = templates.bbb_nu, BBB_4plot
 
-        #Call object containing all torus models     
-        torus_object = cPickle.load(file(path + 'models/TORUS/silva_v1.pickle', 'rb')) 
-        nhidx=len(torus_object.SED)
-        #Construct dictionaries 
-        for nhi in range(nhidx):
+        library['nh'] = templates.nh
+        library['TORUS_4plot'] = templates.tor_nu, templates.tor_Fnu
 
-            tor_nu0, tor_Fnu0 = torus_object.wave[nhi], torus_object.SED[nhi].squeeze()
-            TORUSFdict_4plot[str(torus_object.nh[nhi])] = tor_nu0, tor_Fnu0
+        self.library = library
+        return library
 
-            bands, tor_Fnu_filtered = model.filters1(tor_nu0, tor_Fnu0, filterdict, z)
-            TORUSFdict_filtered[str(torus_object.nh[nhi])] = bands, tor_Fnu_filtered
-            if np.amax(tor_Fnu_filtered) == 0:
-                print 'Error: something is wrong in the calculation of TORUS flux'
 
+    def construct_dictionaryarray_filtered(self, z, filterdict,path):
+
+        """
+        Construct the arrays of fluxes at bands (to compare to data), from the spectra of
+        the rest-frame library: 'GALAXY' [tau, age, ebvgal, bands], 'STARBURST' [irlum, bands],
+        'TORUS' [nh, bands] and 'BBB' [ebvbbb, bands], with the parameter grids and 'bands',
+        or, for a library on the SVD basis (filters['galaxy_svd']), the galaxy
+        fluxes as the coefficients 'GALAXY_svd' [tau, age, k] and the basis 
+        projected on the bands 'GALAXY_basis' [ebvgal, k, bands] (svd_fluxes).
+        """
 
+        library = self.construct_library(path)
+        dict_modelfluxes = dict((key, library[key]) for key in ('tau', 'age', 'ebvgal', 'GALAXY_SFR', 'irlum', 'ebvbbb', 'nh'))
 
+        #Projection of filter curves on models, one matrix per grid of template frequencies
+        projection = model.FILTER_PROJECTION(filterdict, z)
 
-        return STARBURSTFdict_filtered , BBBFdict_filtered, GALAXYFdict_filtered, TORUSFdict_filtered, \
-               STARBURSTFdict_4plot , BBBFdict_4plot, GALAXYFdict_4plot, TORUSFdict_4plot,GALAXY_SFRdict
+        #Projection of filter curves on all galaxy models at once
+        if 'GALAXY_svd' in library:
+            #or on the basis only, whose coefficients do not depend on the redshift
+            gal_nus, GALAXY_4plot_basis = library['GALAXY_4plot_basis']
+            bands, dict_modelfluxes['GALAXY_basis'] = projection(gal_nus, GALAXY_4plot_basis)
+            dict_modelfluxes['GALAXY_svd'] = library['GALAXY_svd']
+        else:
+            gal_nus, GALAXY_4plot = library['GALAXY_4plot']
+            bands, dict_modelfluxes['GALAXY'] = projection(gal_nus, GALAXY_4plot)
+
+        for family in 'STARBURST', 'BBB', 'TORUS':
+            if family == 'STARBURST':
+                spectra = library['STARBURST_4plot']
+            elif family == 'BBB':
+                bbb_nu, BBB_4plot = library['BBB_4plot']
+                spectra = [(bbb_nu, Fnu) for Fnu in BBB_4plot]
+            else:
+                spectra = zip(*library['TORUS_4plot'])
+
+            Fnu_filtered = np.zeros((len(spectra), len(bands)))
+            for i, (nu0, Fnu0) in enumerate(spectra):
+                bands, Fnu_filtered_i = projection(nu0, Fnu0)
+                Fnu_filtered[i] = Fnu_filtered_i.ravel()
+            dict_modelfluxes[family] = Fnu_filtered
+
+        dict_modelfluxes['bands'] = bands
+
+        #What it was constructed with, for the updates (MODELSDICT.update)
+        dict_modelfluxes['z'] = z
+        dict_modelfluxes['filterfiles'] = [filterdict[1][nu] for nu in bands]
+
+        return dict_modelfluxes
                
 
 
 
 
+class TEMPLATE_LIBRARY:
+
+    """
+    Class TEMPLATE_LIBRARY
+
+    The source templates of the galaxy, starburst, BBB and torus models, read from 
+    their pickle files (CONSTRUCT_modelobjects.py) and preprocessed once for all 
+    redshifts of MODELSDICT.
+
+    ##input: 
+    - the path of the models
+    """
+
+    def __init__(self, path):
+
+        galaxy_object = cPickle.load(file(path + 'models/GALAXY/bc03_275templates.pickle', 'rb'))
+        gal_wl = galaxy_object.wave
+        gal_nus = gal_wl.to(u.Hz, equivalencies=u.spectral()).value[::-1]#invert
+        # SED [.., age, tau, .., .., wavelength] to Fnu [tau, age, nu]
+        gal_Fnu = (galaxy_object.SED.value[0,:,:,0,0,:] * 3.34e-19 * gal_wl.value**2.)[..., ::-1]
+        self.gal_nu = gal_nus[0:len(gal_nus):3]
+        self.gal_Fnu = gal_Fnu.transpose(1, 0, 2)[..., 0:len(gal_nus):3]
+        self.gal_SFR = galaxy_object.SFR.value[0,:,:,0,0].T
+        self.tau = galaxy_object.tau.value
+        self.age = galaxy_object.tg.value
+
+        starburst_object = cPickle.load(file(path + 'models/STARBURST/dalehelou_charyelbaz_v1.pickle', 'rb'))
+        #Sorted grid of irlum. For repeated irlum values the last template is used.
+        irlum, irlum_last = np.unique(starburst_object.irlum[::-1], return_index=True)
+        irlum_templates = len(starburst_object.irlum) - 1 - irlum_last
+        self.irlum = irlum
+        self.sb_nu = [starburst_object.wave[i] for i in irlum_templates]
+        self.sb_Fnu = [starburst_object.SED[i].squeeze() for i in irlum_templates]
+
+        bbb_object = cPickle.load(file(path + 'models/BBB/richards.pickle', 'rb'))
+        self.bbb_nu, self.bbb_Fnu = bbb_object.wave, bbb_object.SED.squeeze()
+
+        torus_object = cPickle.load(file(path + 'models/TORUS/silva_v1.pickle', 'rb'))
+        nh_sort = np.argsort(torus_object.nh)
+        self.nh = np.array(torus_object.nh)[nh_sort]
+        self.tor_nu = np.array(torus_object.wave)[nh_sort]
+        self.tor_Fnu = np.array(torus_object.SED)[nh_sort]
+
+
+
+
+class SHARDED_MODELSDICT:
+
+    """
+    Class SHARDED_MODELSDICT
+
+    Dictionary of models stored in a directory, with one slice (subdirectory) per 
+    redshift key and one for the rest-frame library (LIBRARY), loaded when asked for,
+    with the arrays memory-mapped (save_slice). Assigning a key writes its slice.
+
+    ##input: 
+    - path of the directory
+    - number of slices kept loaded
+    """
+
+    def __init__(self, path, cache_size=8):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __getstate__(self):
+        return self.path, self.cache_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def keys(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(key for key in os.listdir(self.path) 
+                      if not key.endswith(('.tmp', '.old')) 
+                      and os.path.isfile(os.path.join(self.path, key, 'items.pickle')))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.cache or os.path.isfile(os.path.join(self.path, key, 'items.pickle'))
+
+    def __getitem__(self, key):
+
+        if key in self.cache:
+            MODELSdict = self.cache.pop(key)
+        elif key in self:
+            MODELSdict = load_slice(os.path.join(self.path, key))
+        else:
+            raise KeyError(key)
+
+        self.cache[key] = MODELSdict
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return MODELSdict
+
+    def __setitem__(self, key, MODELSdict):
+
+        #written aside and then moved, the former slice may still be mapped in memory
+        slicepath = os.path.join(self.path, key)
+        save_slice(slicepath + '.tmp', MODELSdict)
+        if os.path.isdir(slicepath):
+            os.rename(slicepath, slicepath + '.old')
+        os.rename(slicepath + '.tmp', slicepath)
+        shutil.rmtree(slicepath + '.old', ignore_errors=True)
+        self.cache.pop(key, None)
+
+
+
+
+def save_slice(slicepath, MODELSdict):
+
+    """
+    Writes the dictionary of one redshift (or the rest-frame library) into the 
+    directory slicepath, as a slice of a SHARDED_MODELSDICT: the arrays as .npy files, 
+    the tuples of arrays as one .npy file per element, and the other values 
+    into 'items.pickle', with the number of elements of each tuple.
+    """
+
+    if os.path.isdir(slicepath):
+        shutil.rmtree(slicepath)
+    os.makedirs(slicepath)
+
+    isarray = lambda value: isinstance(value, np.ndarray) and value.dtype != object
+    items = dict()
+    tuples = dict()
+    for key, value in MODELSdict.items():
+        if isarray(value):
+            np.save(os.path.join(slicepath, key + '.npy'), value)
+        elif isinstance(value, tuple) and all(isarray(v) for v in value):
+            tuples[key] = len(value)
+            for i, v in enumerate(value):
+                np.save(os.path.join(slicepath, '%s.%i.npy' % (key, i)), v)
+        else:
+            items[key] = value
+
+    with open(os.path.join(slicepath, 'items.pickle'), 'wb') as f:
+        cPickle.dump((items, tuples), f, protocol=2)
+
+
+
+def load_slice(slicepath):
+
+    """
+    Reads the dictionary of one redshift (or the rest-frame library) written by 
+    save_slice, with the arrays memory-mapped (read-only).
+    """
+
+    with open(os.path.join(slicepath, 'items.pickle'), 'rb') as f:
+        items, tuples = cPickle.load(f)
+
+    MODELSdict = dict(items)
+    for filename in os.listdir(slicepath):
+        key, ext = os.path.splitext(filename)
+        if ext == '.npy' and key.rsplit('.', 1)[0] not in tuples:
+            MODELSdict[key] = np.load(os.path.join(slicepath, filename), mmap_mode='r')
+    for key, n in tuples.items():
+        MODELSdict[key] = tuple(np.load(os.path.join(slicepath, '%s.%i.npy' % (key, i)), mmap_mode='r') 
+                                for i in range(n))
+    return MODELSdict
+
+
+
+def load_modelsdict(path):
+
+    """
+    Dictionary of models saved in path: a SHARDED_MODELSDICT if path is a directory
+    (filters['dict_sharded']), otherwise the dictionary loaded from the pickle file.
+    """
+
+    if os.path.isdir(path):
+        return SHARDED_MODELSDICT(path)
+    return cPickle.load(file(path, 'rb'))
+
+
+
+
+def _build_worker_init(modelsdict):
+
+    """Initializer of the processes of MODELSDICT.build."""
+
+    global _modelsdict_worker
+    _modelsdict_worker = modelsdict
+
+
+def _build_worker(task):
+
+    """Dictionary of redshift z, constructed in a process of MODELSDICT.build,
+    or (z, bands) or LIBRARY of MODELSDICT.update."""
+
+    return _build_task(_modelsdict_worker, task)
+
+
+def _build_task(modelsdict, task):
+
+    """Item (key, dictionary) of the task of MODELSDICT.build or MODELSDICT.update."""
+
+    if task == LIBRARY:
+        return LIBRARY, modelsdict.construct_library_stored()
+    if isinstance(task, tuple):
+        return modelsdict.construct_z(*task)
+    return modelsdict.construct_z(task)
+
+
+
+def modelsdict_z(MODELSdict, bands, float32=False, ebv_degree=0):
+
+    """
+    Dictionary of one redshift of the dictionary of models, prepared for the fit: with only
+    the bands of the filter set (select_bands), the galaxy and BBB fluxes as polynomials
+    in E(B-V) if ebv_degree (ebv_polynomial), and in single precision if float32.
+    """
+
+    if isinstance(MODELSdict, tuple):
+        MODELSdict = dictarrays_from_dicts(MODELSdict)
+    MODELSdict = svd_fluxes(select_bands(MODELSdict, bands))
+    if ebv_degree and 'ebv_polynomial' not in MODELSdict:
+        MODELSdict = ebv_polynomial(MODELSdict, ebv_degree)
+    if float32 and 'lognorm' not in MODELSdict:
+        MODELSdict = single_precision(MODELSdict)
+
+    return MODELSdict
+
+
+
+def modelsdict_interpolated(Modelsdict, z, bands, float32=False, ebv_degree=0):
+
+    """
+    Dictionary of redshift z, prepared for the fit as modelsdict_z, with the fluxes
+    interpolated linearly in z between the two redshifts of the dictionary of models
+    which bracket z (filters['z_interpolation']), or those of the nearest one outside of them.
+    The fluxes at the bands are not smooth in z, so the error varies strongly between redshifts.
+    """
+
+    z_keys = redshift_keys(Modelsdict)
+    z_array = z_keys.astype(float)
+    below, above = z_array <= z, z_array >= z
+    if not below.any() or not above.any() or np.any(z_array == z):
+        return modelsdict_z(Modelsdict[z_keys[np.abs(z_array - z).argmin()]], bands, float32, ebv_degree)
+
+    i0 = np.flatnonzero(below)[z_array[below].argmax()]
+    i1 = np.flatnonzero(above)[z_array[above].argmin()]
+    w = (z - z_array[i0]) / (z_array[i1] - z_array[i0])
+    MODELSdict0 = modelsdict_z(Modelsdict[z_keys[i0]], bands)
+    MODELSdict1 = modelsdict_z(Modelsdict[z_keys[i1]], bands)
+
+    dict_modelfluxes = dict((key, value) for key, value in MODELSdict0.items() 
+                            if key not in ('lognorm', 'ebv_polynomial') and not key.endswith('_ebvpoly'))
+    for family in 'GALAXY', 'STARBURST', 'BBB', 'TORUS':
+        dict_modelfluxes[family] = (1.-w)*grid_fluxes(MODELSdict0, family) + w*grid_fluxes(MODELSdict1, family)
+    dict_modelfluxes['z'] = z
+    #the polynomials of stored dictionaries are fitted again to the interpolated fluxes
+    ebv_degree = ebv_degree or MODELSdict0.get('ebv_polynomial', 0)
+    if ebv_degree:
+        dict_modelfluxes = ebv_polynomial(dict_modelfluxes, ebv_degree)
+    if float32:
+        dict_modelfluxes = single_precision(dict_modelfluxes)
+
+    return dict_modelfluxes
+
+
+
+def redshift_keys(Modelsdict):
+
+    """
+    Keys of the redshifts of the dictionary of models (all keys but LIBRARY), as an array.
+    """
+
+    return np.array([key for key in Modelsdict.keys() if key != LIBRARY])
+
+
+
+def restframe_library(Modelsdict, z_key, float32=False):
+
+    """
+    Rest-frame spectral library of the dictionary of models (MODELSDICT.construct_library),
+    in single precision if float32 (single_precision). The dictionaries of earlier versions 
+    have no library, but the spectra for plotting at each redshift: those of z_key are taken.
+    """
+
+    if LIBRARY in Modelsdict:
+        library = Modelsdict[LIBRARY]
+    elif isinstance(Modelsdict[z_key], tuple):
+        library = dictarrays_from_dicts(Modelsdict[z_key])
+    else:
+        library = Modelsdict[z_key]
+    library = dict((key, value) for key, value in library.items() 
+                   if key.endswith('_4plot') or key in ('GALAXY_4plot_basis', 'GALAXY_svd', 'lognorm'))
+    if float32 and 'lognorm' not in library:
+        library = single_precision(library)
+
+    return library
+
+
+
+def merge_bands(MODELSdict, MODELSdict_bands):
+
+    """
+    Merges the fluxes at new bands, MODELSdict_bands (constructed for the same redshift
+    and models, at these bands only), into the dictionary of one redshift MODELSdict,
+    in increasing order of the bands, and stored as in MODELSdict (single precision,
+    SVD basis, polynomials in E(B-V)).
+    """
+
+    if 'GALAXY_svd' in MODELSdict or 'GALAXY_svd' in MODELSdict_bands:
+        if 'GALAXY_svd' not in MODELSdict or 'GALAXY_svd' not in MODELSdict_bands or \
+           not np.array_equal(MODELSdict['GALAXY_svd'], MODELSdict_bands['GALAXY_svd']):
+            MODELSdict, MODELSdict_bands = svd_fluxes(MODELSdict), svd_fluxes(MODELSdict_bands)
+
+    if 'ebv_polynomial' in MODELSdict:
+        MODELSdict_bands = ebv_polynomial(MODELSdict_bands, MODELSdict['ebv_polynomial'])
+        grid = [family for family in ('GALAXY', 'BBB') 
+                if (family+'_ebvpoly' in MODELSdict) != (family+'_ebvpoly' in MODELSdict_bands)]
+        MODELSdict, MODELSdict_bands = ebv_grid(MODELSdict, grid), ebv_grid(MODELSdict_bands, grid)
+
+    dict_modelfluxes = dict(MODELSdict)
+    order = np.argsort(np.concatenate((MODELSdict['bands'], MODELSdict_bands['bands'])), kind='mergesort')
+    dict_modelfluxes['bands'] = np.concatenate((MODELSdict['bands'], MODELSdict_bands['bands']))[order]
+    filterfiles = MODELSdict.get('filterfiles', [None]*len(MODELSdict['bands'])) + MODELSdict_bands['filterfiles']
+    dict_modelfluxes['filterfiles'] = [filterfiles[i] for i in order]
+
+    if 'GALAXY_basis' in MODELSdict:
+        dict_modelfluxes['GALAXY_basis'] = np.concatenate((MODELSdict['GALAXY_basis'], MODELSdict_bands['GALAXY_basis']), 
+                                                          axis=-1)[..., order]
+
+    for family in 'GALAXY', 'STARBURST', 'BBB', 'TORUS':
+        if family+'_ebvpoly' in MODELSdict:
+            coefs = [MODELSdict[family+'_ebvpoly'], MODELSdict_bands[family+'_ebvpoly']]
+            degree = max(c.shape[-2] for c in coefs)
+            #zeros as the leading coefficients of the lower degree
+            coefs = [np.concatenate((np.zeros(c.shape[:-2] + (degree - c.shape[-2], c.shape[-1])), c), axis=-2) 
+                     for c in coefs]
+            dict_modelfluxes[family+'_ebvpoly'] = np.concatenate(coefs, axis=-1)[..., order]
+        if family not in MODELSdict:
+            continue
+        Fnu = double_precision_fluxes(MODELSdict_bands, family, MODELSdict_bands[family])
+        if 'lognorm' in MODELSdict:
+            Fnu = (Fnu*10**(-MODELSdict['lognorm'][family])).astype(np.float32)
+        dict_modelfluxes[family] = np.concatenate((MODELSdict[family], Fnu), axis=-1)[..., order]
+    check_fluxes(dict_modelfluxes)
+
+    return dict_modelfluxes
+
+
+
+def check_fluxes(MODELSdict):
+
+    """
+    Prints an error for each starburst, BBB and torus template of the dictionary of 
+    one redshift with no flux at any of its bands.
+    """
+
+    for family in 'STARBURST', 'BBB', 'TORUS':
+        for i in np.flatnonzero(np.amax(grid_fluxes(MODELSdict, family), axis=-1) == 0):
+            print 'Error: something is wrong in the calculation of %s flux' % family
+
+
+
+def select_bands(MODELSdict, bands):
+
+    """
+    Dictionary of one redshift with only the given bands (central frequencies of the filter set),
+    in their order, for a dictionary which contains more bands (e.g. after MODELSDICT.update
+    for another catalog). Returns MODELSdict itself if it has exactly these bands.
+    """
+
+    if np.array_equal(MODELSdict['bands'], bands):
+        return MODELSdict
+
+    missing = np.setdiff1d(bands, MODELSdict['bands'])
+    if len(missing):
+        print 'ERROR: the model dictionary does not contain the bands', missing
+        print 'Rerun RUN_AGNfitter_multi.py to add them to the dictionary.'
+        sys.exit(1)
+
+    idx = np.searchsorted(MODELSdict['bands'], bands)
+    dict_modelfluxes = dict(MODELSdict)
+    dict_modelfluxes['bands'] = MODELSdict['bands'][idx]
+    if 'filterfiles' in MODELSdict:
+        dict_modelfluxes['filterfiles'] = [MODELSdict['filterfiles'][i] for i in idx]
+    for key in 'GALAXY', 'GALAXY_basis', 'GALAXY_ebvpoly', 'STARBURST', 'BBB', 'BBB_ebvpoly', 'TORUS':
+        if key in MODELSdict:
+            dict_modelfluxes[key] = MODELSdict[key][..., idx]
+
+    return dict_modelfluxes
+
+
+
 def dictkey_arrays(MODELSdict):
 
     """
-    Construct the dictionaries of fluxes at bands (to campare to data), 
-    and dictionaries of fluxes over the whole spectrum, for plotting.
+    Construct the index of the parameter grids of the model dictionary,
+    used to pick the templates nearest to the MCMC parameter values.
 
     ##input:
+    - dictionary of models for one redshift (MODELSDICT.construct_dictionaryarray_filtered)
 
     ##output:
+    - TEMPLATE_INDEX object (MODEL_AGNfitter), with the galaxy SFRs [tau, age],
+      which keeps no state of the lookups (it can be used by several threads at once)
+    """
+
+    return model.TEMPLATE_INDEX(MODELSdict['tau'], MODELSdict['age'], MODELSdict['ebvgal'],
+                                MODELSdict['irlum'], MODELSdict['nh'], MODELSdict['ebvbbb'],
+                                MODELSdict['GALAXY_SFR'])
+
+
+
+def dictarrays_from_dicts(MODELSdict):
+
+    """
+    Converts the dictionary of one redshift stored in the former format
+    (tuple of dictionaries with string keys) to the current format of
+    dense arrays (see MODELSDICT.construct_dictionaryarray_filtered).
+    Allows to use dictionaries constructed with earlier versions.
+    """
+
+    STARBURSTFdict , BBBFdict, GALAXYFdict, TORUSFdict, \
+    STARBURSTFdict_4plot , BBBFdict_4plot, GALAXYFdict_4plot, TORUSFdict_4plot, GALAXY_SFRdict= MODELSdict
+
+    galkeys = np.array(list(GALAXYFdict.keys()))
+    tau_keys, age_keys, ebvg_keys = [sorted(set(galkeys[:,i]), key=float) for i in range(3)]
+    irlum_keys = sorted(STARBURSTFdict.keys(), key=float)
+    nh_keys = sorted(TORUSFdict.keys(), key=float)
+    ebvb_keys = sorted(BBBFdict.keys(), key=float)
+
+    dict_modelfluxes = dict()
+    dict_modelfluxes['bands'] = STARBURSTFdict[irlum_keys[0]][0]
+    dict_modelfluxes['tau'] = np.array(tau_keys, dtype=float)
+    dict_modelfluxes['age'] = np.array(age_keys, dtype=float)
+    dict_modelfluxes['ebvgal'] = np.array(ebvg_keys, dtype=float)
+    dict_modelfluxes['irlum'] = np.array(irlum_keys, dtype=float)
+    dict_modelfluxes['nh'] = np.array(nh_keys, dtype=float)
+    dict_modelfluxes['ebvbbb'] = np.array(ebvb_keys, dtype=float)
+
+    dict_modelfluxes['GALAXY'] = np.array([[[GALAXYFdict[t, a, e][1].ravel() for e in ebvg_keys] 
+                                            for a in age_keys] for t in tau_keys])
+    dict_modelfluxes['GALAXY_4plot'] = GALAXYFdict_4plot[tau_keys[0], age_keys[0], ebvg_keys[0]][0], \
+                                       np.array([[[GALAXYFdict_4plot[t, a, e][1] for e in ebvg_keys] 
+                                                  for a in age_keys] for t in tau_keys])
+    dict_modelfluxes['GALAXY_SFR'] = np.array([[np.array(getattr(GALAXY_SFRdict[t, a], 'value', GALAXY_SFRdict[t, a])) 
+                                                for a in age_keys] for t in tau_keys])
+
+    dict_modelfluxes['STARBURST'] = np.array([STARBURSTFdict[k][1].ravel() for k in irlum_keys])
+    dict_modelfluxes['STARBURST_4plot'] = [STARBURSTFdict_4plot[k] for k in irlum_keys]
+    dict_modelfluxes['TORUS'] = np.array([TORUSFdict[k][1].ravel() for k in nh_keys])
+    dict_modelfluxes['TORUS_4plot'] = np.array([TORUSFdict_4plot[k][0] for k in nh_keys]), \
+                                      np.array([TORUSFdict_4plot[k][1] for k in nh_keys])
+    dict_modelfluxes['BBB'] = np.array([BBBFdict[k][1].ravel() for k in ebvb_keys])
+    dict_modelfluxes['BBB_4plot'] = BBBFdict_4plot[ebvb_keys[0]][0], \
+                                    np.array([BBBFdict_4plot[k][1] for k in ebvb_keys])
+
+    return dict_modelfluxes
+
+
+
+
+def single_precision(MODELSdict):
+
+    """
+    Converts the template fluxes of the dictionary of one redshift, or of the
+    rest-frame library, to single precision (float32), each family divided by
+    the power of ten saved in dict_modelfluxes['lognorm'] (double_precision_fluxes).
+    """
+
+    dict_modelfluxes = dict(MODELSdict)
+    dict_modelfluxes['lognorm'] = dict()
+
+    for family in 'GALAXY', 'STARBURST', 'BBB', 'TORUS':
+        if family not in MODELSdict and family+'_4plot' not in MODELSdict:
+            #stored as polynomials in E(B-V) (ebv_polynomial), already in log, 
+            #or on the SVD basis (svd_basis), kept in double precision
+            continue
+        if family in MODELSdict:
+            lognorm = np.floor(np.log10(np.max(MODELSdict[family])))
+        else:
+            lognorm = np.floor(np.log10(max(np.max(Fnus) for Fnus in templates_4plot(MODELSdict, family))))
+        dict_modelfluxes['lognorm'][family] = lognorm
+        norm = 10**(-lognorm)
+
+        if family in MODELSdict:
+            dict_modelfluxes[family] = (MODELSdict[family]*norm).astype(np.float32)
+        if family+'_4plot' not in MODELSdict:
+            continue
+        if family == 'STARBURST':
+            dict_modelfluxes[family+'_4plot'] = [(nus, (Fnus*norm).astype(np.float32)) 
+                                                 for nus, Fnus in MODELSdict[family+'_4plot']]
+        else:
+            nus, Fnus = MODELSdict[family+'_4plot']
+            dict_modelfluxes[family+'_4plot'] = nus, (np.asarray(Fnus)*norm).astype(np.float32)
+
+    return dict_modelfluxes
+
+
+
+def ebv_polynomial(MODELSdict, degree, tolerance=1e-3, max_degree=10):
+
+    """
+    Replaces the galaxy and BBB fluxes at the bands of the dictionary of one redshift by
+    polynomials in E(B-V) fitted to their log10, 'GALAXY_ebvpoly' [tau, age, degree+1, bands]
+    and 'BBB_ebvpoly' [degree+1, bands] (as np.polyfit), with the degree raised up to max_degree
+    until they agree with the grid to the relative tolerance (ebv_residual), or else the grid kept.
+    """
+
+    dict_modelfluxes = dict(MODELSdict)
+    dict_modelfluxes['ebv_polynomial'] = degree
+    for family, ebvkey, axis in ('GALAXY', 'ebvgal', 2), ('BBB', 'ebvbbb', 0):
+        ebv = MODELSdict[ebvkey]
+        logF = np.log10(np.moveaxis(double_precision_fluxes(MODELSdict, family, MODELSdict[family]), axis, 0))
+        y = logF.reshape(len(logF), -1)
+        #the reddening does not change the bands at which the template has no flux
+        valid = np.isfinite(y).all(axis=0)
+        for n in range(degree, min(max_degree, len(ebv)-1)+1):
+            coefs = np.zeros((n+1, y.shape[1]))
+            coefs[-1, ~valid] = -np.inf
+            coefs[:, valid] = np.polyfit(ebv, y[:, valid], n)
+            coefs = coefs.reshape((n+1,) + logF.shape[1:])
+            residual = ebv_residual(logF, ebv, coefs)
+            if residual <= tolerance:
+                break
+        else:
+            print 'Note: the %s fluxes are kept on the grid of E(B-V), polynomials of degree' % family, \
+                  'up to %i miss them by %.2g (> %.2g).' % (n, residual, tolerance)
+            continue
+        dict_modelfluxes[family+'_ebvpoly'] = np.moveaxis(coefs, 0, axis)
+        del dict_modelfluxes[family]
+
+    return dict_modelfluxes
+
+
+
+def ebv_residual(logF, ebv, coefs):
+
+    """
+    Maximum relative error of the fluxes of the polynomials in E(B-V) with the 
+    coefficients coefs ([degree+1, ..., bands], as np.polyfit) against the log10 of the 
+    fluxes logF ([ebv, ..., bands]) on the grid ebv, at the bands with more than 1e-3 
+    of the maximum flux of the template.
+    """
+
+    F = 10**logF
+    bright = F > 1e-3*F.max(axis=-1)[..., None]
+    fitted = np.moveaxis(10**np.polynomial.polynomial.polyval(ebv, coefs[::-1]), -1, 0)
+    return np.abs(fitted[bright]/F[bright] - 1).max() if bright.any() else 0.
+
+
+
+def ebv_fluxes(MODELSdict, family, coefs, ebv):
+
+    """
+    log10 of the fluxes of the galaxy or BBB templates with the polynomial coefficients 
+    coefs ([..., degree+1, bands], picked from MODELSdict[family+'_ebvpoly']), at E(B-V) ebv
+    (a value, or an array broadcast with coefs[..., 0, 0]), limited to the grid of E(B-V)
+    the polynomials were fitted on.
+    """
+
+    grid = MODELSdict['ebvgal'] if family == 'GALAXY' else MODELSdict['ebvbbb']
+    ebv = np.expand_dims(np.clip(ebv, grid[0], grid[-1]), -1)
+    logF = coefs[..., 0, :]
+    for i in range(1, coefs.shape[-2]):
+        logF = logF*ebv + coefs[..., i, :]
+    return logF
+
+
+
+def grid_fluxes(MODELSdict, family):
+
+    """
+    Fluxes of the given family at the bands, on the grids of parameters, in double 
+    precision, also for dictionaries in single precision (double_precision_fluxes) 
+    or with polynomials in E(B-V) (evaluated on the grid, ebv_fluxes).
+    """
+
+    if family+'_ebvpoly' not in MODELSdict:
+        return double_precision_fluxes(MODELSdict, family, MODELSdict[family])
+
+    #one more axis of the coefficients for the grid of E(B-V), before the bands
+    coefs = np.expand_dims(MODELSdict[family+'_ebvpoly'], -3)
+    ebv = MODELSdict['ebvgal'] if family == 'GALAXY' else MODELSdict['ebvbbb']
+    return 10**ebv_fluxes(MODELSdict, family, coefs, ebv)
+
+
+
+def ebv_grid(MODELSdict, families=('GALAXY', 'BBB')):
+
+    """
+    Dictionary of one redshift with the fluxes of the families stored as polynomials 
+    in E(B-V) (ebv_polynomial) evaluated back on the grid of E(B-V) (grid_fluxes), 
+    in the precision of the other families (single_precision).
+    """
+
+    dict_modelfluxes = dict(MODELSdict)
+    for family in families:
+        if family+'_ebvpoly' not in MODELSdict:
+            continue
+        Fnu = grid_fluxes(MODELSdict, family)
+        del dict_modelfluxes[family+'_ebvpoly']
+        if 'lognorm' in MODELSdict:
+            lognorm = np.floor(np.log10(np.max(Fnu)))
+            dict_modelfluxes['lognorm'] = dict(dict_modelfluxes['lognorm'], **{family: lognorm})
+            Fnu = (Fnu*10**(-lognorm)).astype(np.float32)
+        dict_modelfluxes[family] = Fnu
+
+    return dict_modelfluxes
+
+
+
+def svd_basis(Fnu, tolerance):
+
+    """
+    Truncated SVD of the spectra Fnu [..., nus]: coefficients [..., k] and basis [k, nus]
+    with the fewest components k which reconstruct every spectrum (coefficients.dot(basis))
+    to tolerance times its maximum (the spectra being normalised for the decomposition).
+    """
+
+    spectra = Fnu.reshape(-1, Fnu.shape[-1])
+    norm = spectra.max(axis=1)[:, None]
+    U, s, Vt = np.linalg.svd(spectra/norm, full_matrices=False)
+
+    residual = spectra/norm
+    for k in range(1, len(s)+1):
+        residual -= np.outer(U[:, k-1]*s[k-1], Vt[k-1])
+        if np.abs(residual).max() <= tolerance:
+            break
+
+    coefs = U[:, :k]*s[:k]*norm
+    return coefs.reshape(Fnu.shape[:-1] + (k,)), Vt[:k]
+
+
+
+def svd_fluxes(MODELSdict):
+
+    """
+    Dictionary of one redshift with the galaxy fluxes at the bands stored on the SVD basis
+    reconstructed into the array 'GALAXY' [tau, age, ebvgal, bands], or MODELSdict itself
+    if its galaxy fluxes are not on the SVD basis.
     """
 
-    STARBURSTFdict , BBBFdict, GALAXYFdict, TORUSFdict, _,_,_,_,GALAXY_SFRdict= MODELSdict
-    tau_dict= np.array(list(GALAXYFdict.keys()))[:,0]
-    age_dict= np.array(list(GALAXYFdict.keys()))[:,1]
-    ebvg_dict = np.array(list(GALAXYFdict.keys()))[:,2]
+    if 'GALAXY_svd' not in MODELSdict:
+        return MODELSdict
+
+    dict_modelfluxes = dict((key, value) for key, value in MODELSdict.items() 
+                            if key not in ('GALAXY_svd', 'GALAXY_basis'))
+    #the truncation leaves small negative fluxes where the templates have (almost) none
+    Fnu = np.maximum(np.tensordot(MODELSdict['GALAXY_svd'], MODELSdict['GALAXY_basis'], axes=(-1, 1)), 0.)
+    if 'lognorm' in MODELSdict:
+        lognorm = np.floor(np.log10(np.max(Fnu)))
+        dict_modelfluxes['lognorm'] = dict(MODELSdict['lognorm'], GALAXY=lognorm)
+        Fnu = (Fnu*10**(-lognorm)).astype(np.float32)
+    dict_modelfluxes['GALAXY'] = Fnu
+
+    return dict_modelfluxes
+
 
-    irlum_dict = np.array(list(STARBURSTFdict.keys()))
-    nh_dict = np.array(list(TORUSFdict.keys()))
-    ebvb_dict = np.array(list(BBBFdict.keys()))
 
+def galaxy_4plot(library, tau_dct, age_dct, ebvg_dct):
+
+    """
+    Galaxy spectra for plotting of the rest-frame library, at the given indices of the 
+    grids of tau, age and ebvgal: log frequencies and fluxes in double precision, 
+    reconstructed from the SVD basis if the library is stored on it (MODELSDICT.construct_library).
+    """
+
+    if 'GALAXY_svd' in library:
+        gal_nus, GALAXY_4plot_basis = library['GALAXY_4plot_basis']
+        coefs = np.expand_dims(library['GALAXY_svd'][tau_dct, age_dct], -1)
+        return gal_nus, np.maximum(np.sum(coefs*GALAXY_4plot_basis[ebvg_dct], axis=-2), 0.)
 
-    #For computational reasons (to be used in PARAMETERspace_AGNfitter.py)
-    class gal_class:
-        def __init__(self, tau_dict, age_dict, ebvg_dict):
-            self.tau_dict =tau_dict
-            self.age_dict= age_dict
-            self.ebvg_dict = ebvg_dict
-            self.tau_dict_float =tau_dict.astype(float)
-            self.age_dict_float= age_dict.astype(float)
-            self.ebvg_dict_float = ebvg_dict.astype(float)
+    gal_nus, GALAXY_4plot = library['GALAXY_4plot']
+    return gal_nus, double_precision_fluxes(library, 'GALAXY', GALAXY_4plot[tau_dct, age_dct, ebvg_dct])
 
-        def nearest_par2dict(self, tau, age, ebvg):    
-            taui =np.abs(self.tau_dict_float-tau).argmin()
-            agei= np.abs(self.age_dict_float-age).argmin()
-            ebvgi = np.abs(self.ebvg_dict_float-ebvg).argmin()
 
-            self.t = tau_dict[taui]
-            self.a= age_dict[agei]
-            self.e= ebvg_dict[ebvgi]
 
-    gal_obj = gal_class(tau_dict, age_dict, ebvg_dict)
+def double_precision_fluxes(MODELSdict, family, Fnu):
 
-    return gal_obj, irlum_dict, nh_dict, ebvb_dict, GALAXY_SFRdict
+    """
+    Template fluxes Fnu of the given family, picked from the dictionary of one redshift
+    or from the rest-frame library, in double precision and at their original scale. 
+    Fnu is returned as it is for dictionaries in double precision (see single_precision).
+    """
+
+    if 'lognorm' in MODELSdict:
+        return np.asarray(Fnu, dtype=float)*10**MODELSdict['lognorm'][family]
+    return Fnu
+
+
+
+
+def templates_nbytes(MODELSdict):
+
+    """
+    Size in bytes of the template fluxes (at the bands and/or for plotting)
+    of the dictionary of one redshift or of the rest-frame library.
+    """
+
+    nbytes = 0
+    for family in 'GALAXY', 'STARBURST', 'BBB', 'TORUS':
+        for key in family, family+'_ebvpoly', family+'_svd', family+'_basis':
+            if key in MODELSdict:
+                nbytes += MODELSdict[key].nbytes
+        if family+'_4plot_basis' in MODELSdict:
+            nbytes += MODELSdict[family+'_4plot_basis'][1].nbytes
+        nbytes += sum(np.asarray(F).nbytes for F in templates_4plot(MODELSdict, family))
+    return nbytes
+
+
+
+def templates_4plot(MODELSdict, family):
+
+    """
+    List of the arrays of fluxes for plotting of the given family (none if 
+    MODELSdict, e.g. the dictionary of one redshift, does not contain them).
+    """
 
+    if family+'_4plot' not in MODELSdict:
+        return []
+    plot = MODELSdict[family+'_4plot']
+    return [F for nus, F in plot] if family == 'STARBURST' else [plot[1]]
 
 
 
@@ -0,0 +1,575 @@
+"""
+
+%%%%%%%%%%%%%%%%%%
+
+GRID_AGNfitter.py
+
+%%%%%%%%%%%%%%%%%%
+
+This script contains the exhaustive grid fitting, an alternative to the MCMC sampling
+(MCMC_AGNfitter.py), selected with mc['engine'] = 'grid': the amplitudes are fitted
+for every combination of templates, and draws from the posterior on the grid
+are saved in the format of the MCMC chains.
+
+"""
+
+import sys,os
+import time
+import numpy as np
+import cPickle
+import PARAMETERSPACE_AGNfitter as parspace
+import DICTIONARIES_AGNfitter as dicts
+from DATA_AGNfitter import DATA
+
+
+# all values of each parameter grid, when the settings have no mc['grid_thinning']
+GRID_THINNING = dict(tau=1, age=1, Nh=1, irlum=1, EBVbbb=1, EBVgal=1)
+
+
+def main(data, P, mc):
+
+    """
+    Main function for the grid fitting.
+    Computes the chi**2 of all combinations of templates and saves
+    mc['grid_draws'] draws from the posterior into the file of the MCMC chains.
+
+    ##input:
+    - object data of class DATA (DATA_AGNfitter.py)
+    - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
+    - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    """
+
+    t1 = time.time()
+    grid = GRID(data, P, mc.get('grid_thinning', GRID_THINNING))
+
+    print '......................................................'
+    print 'grid of templates:', ' x '.join(['%i %s' % (len(grid.values[n]), n) for n in grid.names])
+    print '%i combinations' % grid.ncombinations
+    print '......................................................'
+
+    #best fit and draws from the posterior, in random order,
+    #the first one being the best fit
+    rstate = np.random.RandomState(mc.get('grid_seed', 0))
+    Ndraws = -(-mc.get('grid_draws', 10000) // mc['Nwalkers']) * mc['Nwalkers']
+    logZ, chi2_min, best, lnmarg, draws = grid.scan(Ndraws, rstate)
+    chi2_min, best, (draws, lnprob) = chi2_min[0], best[0], draws[0]
+    if not np.isfinite(chi2_min):
+        print 'ERROR: no combination of templates fulfills the priors.'
+        sys.exit(1)
+    draws[0], lnprob[0] = best, -0.5*chi2_min
+    draws = grid.combination(draws)
+
+    chain = parspace.add_amplitudes(draws, data, P, random_state=rstate)
+    chain[0] = parspace.add_amplitudes(draws[:1], data, P, draw=False)[0]
+    chain = chain.reshape(mc['Nwalkers'], -1, len(P.names))
+
+    if not os.path.lexists(data.output_folder+str(data.name)):
+        os.mkdir(data.output_folder+str(data.name))
+
+    #same format as MCMC_AGNfitter.save_chains, the draws are independent (not thinned by PLOTandWRITE)
+    chain = chain.astype(data.dict_modelfluxes['STARBURST'].dtype, copy=False)
+    f = open(data.output_folder+str(data.name)+'/samples_mcmc.sav', 'wb')
+    cPickle.dump(dict(
+        chain=chain, accept=np.ones(mc['Nwalkers']), lnprob=lnprob.reshape(chain.shape[:2]).astype(chain.dtype),
+        final_pos=chain[:,-1], state=None, acor=np.ones(len(P.names)), independent=True), f, protocol=2)
+    f.close()
+
+    print 'best fit: chi2 = %.4g' % chi2_min
+    print '%.2g min elapsed' % ((time.time() - t1)/60.)
+
+
+
+def main_catalog(data_all, filters, Modelsdict, mc):
+
+    """
+    Grid fitting of all sources of the catalog (mc['engine'] = 'catalog'), grouped by
+    the nearest redshift of the model dictionary. The best fit and the percentiles 16, 50, 84
+    of each source are written into grid_outvalues_catalog.txt, in the output folder.
+
+    ##input:
+    - object data_all of class DATA_all (DATA_AGNfitter.py)
+    - dictionary filters, of filter settings (RUN_AGNfitter_multi.py)
+    - model dictionary Modelsdict
+    - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    """
+
+    t0 = time.time()
+    nsources = data_all.cat['nsources']
+    if filters.get('z_interpolation', False):
+        print 'The catalog engine fits each source with the nearest redshift of the dictionary (no z interpolation).'
+    z_array = dicts.redshift_keys(Modelsdict)
+    zbin = np.abs(z_array.astype(float)[None,:] - data_all.z[:,None]).argmin(axis=1)
+    bands = dicts.filter_dictionaries(filters['Bandset'], data_all.path, filters)[0]
+
+    names = 'tau', 'age', 'Nh', 'irlum', 'EBVbbb', 'EBVgal'
+    header = ['name', 'z', 'z_dict', 'chi2'] + ['%s%s' % (n, c) for n in names for c in ('', '_p16', '_p50', '_p84')] \
+             + ['SB', 'BB', 'GA', 'TO']
+    #the names are strings, the other columns floats
+    outvalues = np.full((nsources, len(header)), np.nan, dtype=object)
+
+    for b in np.unique(zbin):
+        lines = np.arange(nsources)[zbin == b]
+        z_key = z_array[b]
+        print '______________________________________________________'
+        print 'z = %s: %i sources' % (z_key, len(lines))
+
+        dict_modelfluxes = dicts.modelsdict_z(Modelsdict[z_key], bands, filters.get('float32', False))
+        dictkey_arrays = dicts.dictkey_arrays(dict_modelfluxes)
+
+        sources = []
+        for line in lines:
+            data = DATA(data_all, line)
+            data.dict_modelfluxes = dict_modelfluxes
+            data.dictkey_arrays = dictkey_arrays
+            data.lumfct_prior = parspace.GALAXY_LUMFCT_PRIOR(data.z, data.dlum, dict_modelfluxes['bands'])
+            sources.append((data, parspace.Pdict(data)))
+
+        #the grid of the source with the largest age limit covers the grids of all sources
+        data, P = sources[int(np.argmax([s_P.max[s_P.names.index('age')] for s_data, s_P in sources]))]
+        grid = GRID(data, P, mc.get('grid_thinning', GRID_THINNING))
+        print '%i combinations' % grid.ncombinations
+
+        #sources fitted together, with their scalar products of the templates within about 256 MB
+        nproducts = sum(len(t)*len(u) for k, t in enumerate(grid.templates) for u in grid.templates[k:])
+        step = max(1, 2**25 // nproducts)
+        for i in range(0, len(sources), step):
+            chunk = sources[i:i+step]
+            grid.sources([s_data for s_data, s_P in chunk], [s_P for s_data, s_P in chunk],
+                         template_products(grid.templates, [s_data.lnlike for s_data, s_P in chunk]))
+            logZ, chi2_min, best, lnmarg, draws = grid.scan()
+            for j, ((data, P), line) in enumerate(zip(chunk, lines[i:i+step])):
+                outvalues[line,:3] = data.name, data.z, float(z_key)
+                if not np.isfinite(chi2_min[j]):
+                    print 'WARNING: no combination of templates fulfills the priors for source', data.name
+                    continue
+
+                bestfit = parspace.add_amplitudes(grid.combination(best[j])[None], data, P, draw=False)[0]
+                row = [chi2_min[j]]
+                for n, v in zip(names, grid.combination(best[j])):
+                    row += [v] + list(grid_percentiles(grid.values[n], lnmarg[n][j]))
+                outvalues[line,3:] = row + list(bestfit[list(P.linear)])
+
+    f = data_all.output_folder + '/grid_outvalues_catalog.txt'
+    np.savetxt(f, outvalues, delimiter=' ', fmt=['%s'] + ['%1.4f']*(len(header)-1), header=' '.join(header))
+
+    print '______________________________________________________'
+    print 'grid fit of %i sources in %.2g min, written to %s' % (nsources, (time.time() - t0)/60., f)
+
+
+
+def cells(grid):
+
+    """Lower and upper bounds of the values nearest to each node of the sorted grid
+    (MODEL_AGNfitter.nearest_index)."""
+
+    mid = 0.5*(grid[1:] + grid[:-1])
+    return np.concatenate(([-np.inf], mid)), np.concatenate((mid, [np.inf]))
+
+
+
+def grid_percentiles(values, lnp, q=(16, 50, 84)):
+
+    """Percentiles q of the distribution with log probabilities lnp on the grid values,
+    interpolating its cumulative distribution between the grid values."""
+
+    if len(values) == 1:
+        return np.repeat(values, len(q))
+    p = np.exp(lnp - lnp.max())
+    p /= p.sum()
+    cdf = np.cumsum(p) - 0.5*p
+    return np.interp(np.array(q)/100., cdf, values)
+
+
+
+class GRID:
+
+    """
+    Class GRID
+
+    The grid of template combinations, arrays of shape (ngal, nsb, nbbb, ntor),
+    of one source, or of several sources fitted with the same templates (main_catalog).
+
+    ##input:
+    - object data of class DATA
+    - dictionary P
+    - dictionary thinning, with the step taken along the grid of each parameter
+    """
+
+    # axis of the combinations arrays for each amplitude (SB, BB, GA, TO, as in P.linear)
+    axes = 1, 2, 0, 3
+    # order of the amplitudes in the normal equations, so that most elements
+    # of their Cholesky factor depend on the templates of two or three amplitudes only
+    order = 2, 1, 0, 3
+
+    def __init__(self, data, P, thinning):
+
+        self.names = 'tau', 'age', 'Nh', 'irlum', 'EBVbbb', 'EBVgal'
+        d = data.dict_modelfluxes
+        grids = dict(tau=d['tau'], age=d['age'], Nh=d['nh'], irlum=d['irlum'],
+                     EBVbbb=d['ebvbbb'], EBVgal=d['ebvgal'])
+
+        #grid values whose templates the MCMC picks within the limits of the flat priors
+        #(those of the nodes nearest to the values in between, cells), thinned
+        ix = dict()
+        self.values = dict()
+        self.cells = dict()
+        for n in self.names:
+            i = P.names.index(n)
+            pmin, pmax = (10**P.min[i], 10**P.max[i]) if n == 'age' else (P.min[i], P.max[i])
+            low, high = cells(grids[n])
+            idx = np.arange(len(grids[n]))[(low < pmax) & (high > pmin)]
+            ix[n] = idx[::thinning[n]]
+            self.values[n] = np.log10(grids[n][ix[n]]) if n == 'age' else grids[n][ix[n]]
+            self.cells[n] = low[ix[n]]
+        self.ncombinations = np.prod([len(self.values[n]) for n in self.names])
+
+        #templates, normalised as in ymodel, on the grid of E(B-V) also with polynomials in E(B-V)
+        fluxes = lambda family, idx: dicts.grid_fluxes(d, family)[idx]
+        gal = fluxes('GALAXY', np.ix_(ix['tau'], ix['age'], ix['EBVgal']))
+        self.gal_shape = gal.shape[:3]
+        gal = gal.reshape(-1, gal.shape[-1])/1e18
+        templates = [fluxes('STARBURST', ix['irlum'])/1e20, fluxes('BBB', ix['EBVbbb'])/1e60,
+                     gal, fluxes('TORUS', ix['Nh'])/1e-40]
+        self.shape = tuple(len(templates[k]) for k in np.argsort(self.axes))
+
+        self.templates = templates
+        self.gal_age = self.cells['age'][np.unravel_index(np.arange(len(gal)), self.gal_shape)[1]]
+        self.Amin = 10**np.array(P.min)[list(P.linear)]
+        self.Amax = 10**np.array(P.max)[list(P.linear)]
+
+        #number of combinations for which each subset of free amplitudes was optimal (chi2)
+        self.optimal = dict((tuple(free), 0) for free in SUBSETS)
+
+        self.sources([data], [P], template_products(templates, [data.lnlike]))
+
+    def sources(self, datas, Ps, products):
+
+        """Sets the data of the sources to fit: the scalar products of the templates
+        (from template_products) and the priors. The sources can have a different
+        redshift than the one of the templates (see main_catalog), in which case the galaxy
+        templates whose cells of age are above their limit are excluded."""
+
+        self.norm, self.AA, self.Ay, self.yy = products
+        self.nsources = len(datas)
+        self.c = [self.Amin[k]*self.norm[k] for k in range(4)]
+        #the amplitudes are below their upper limits for x < xmax (chi2)
+        self.xmax = [(self.Amax[k] - self.Amin[k])*self.norm[k] for k in range(4)]
+        agemax = np.array([10**P.max[P.names.index('age')] for P in Ps])
+        self.gal_valid = self.gal_age[None,:] < agemax[:,None]
+
+        #maximal B-band flux of the galaxy templates, for the prior on the luminosity,
+        #fulfilled for x of the galaxy below xmax_B
+        gal = self.templates[2]
+        gal_B = np.array([gal[:,data.lumfct_prior.Bband].max(axis=1) if len(data.lumfct_prior.Bband)
+                          else np.zeros(len(gal)) for data in datas])
+        flux_max = np.array([data.lumfct_prior.flux_max for data in datas])
+        with np.errstate(divide='ignore'):
+            self.xmax_B = np.where(gal_B > 0, (flux_max[:,None]/gal_B - self.Amin[2])*self.norm[2], np.inf)
+
+    def _axis(self, k, x, block):
+
+        """Array x of values for the sources and templates of amplitude k, selected
+        for the block and shaped along its axes (sources, galaxy, starburst, BBB, torus)."""
+
+        src, g, s = block
+        x = x[src]
+        if k == 2:
+            x = x[:,g]
+        elif k == 0:
+            x = x[:,s]
+        shape = [len(src), 1, 1, 1, 1]
+        shape[1+self.axes[k]] = x.shape[1]
+        return x.reshape(shape)
+
+    def _pair(self, k, l, block):
+
+        """Scalar products of the templates of amplitudes k and l, shaped along the axes of the block."""
+
+        if k == l:
+            return self._axis(k, self.AA[k][k], block)
+        src, g, s = block
+        M = self.AA[k][l][src]
+        for i, m in (1, k), (2, l):
+            if m == 2:
+                M = M.take(g, axis=i)
+            elif m == 0:
+                M = M.take(s, axis=i)
+        if self.axes[k] > self.axes[l]:
+            M = M.swapaxes(1, 2)
+        shape = [len(src), 1, 1, 1, 1]
+        shape[1+min(self.axes[k], self.axes[l])], shape[1+max(self.axes[k], self.axes[l])] = M.shape[1:]
+        return M.reshape(shape)
+
+    def chi2(self, block):
+
+        """chi**2 of the combinations of the block (index arrays of the sources, galaxy
+        and starburst templates, with all BBB and torus templates), with the amplitudes
+        fitted within their lower limits (non-negative least-squares), and inf where
+        the amplitudes are above their upper limits or the galaxy luminosity is
+        above the prior. Returns an array of shape (nsources, ngal, nsb, nbbb, ntor)."""
+
+        src, g, s = block
+        full = (len(src), len(g), len(s)) + self.shape[2:]
+
+        AA = symmetric(lambda k, l: self._pair(k, l, block))
+        Ay = [self._axis(k, self.Ay[k], block) for k in range(4)]
+        c = [self._axis(k, self.c[k], block) for k in range(4)]
+
+        # shifted data: b = A^T (y - A.c), c0 = |y - A.c|^2
+        b = [Ay[k] - AA[k][k]*c[k] for k in range(4)]
+        for k in range(4):
+            for l in range(4):
+                if l != k:
+                    b[k] = b[k] - AA[k][l]*c[l]
+        c0 = self.yy[src].reshape(-1, 1, 1, 1, 1) + sum(c[k]*(AA[k][k]*c[k] - 2*Ay[k]) for k in range(4))
+        for k in range(4):
+            for l in range(k+1, 4):
+                c0 = c0 + 2*c[k]*AA[k][l]*c[l]
+
+        flat = lambda v: np.broadcast_to(v, full).ravel().copy()
+        x, bx = solve_subset(AA, b, self.order)
+        x = [flat(x[self.order.index(k)]) for k in range(4)]
+        chi2 = flat(c0 - bx)
+
+        #where the unconstrained solution has negative amplitudes, the solution of the first
+        #subset of free amplitudes which fulfills the optimality conditions:
+        #no negative amplitudes, and chi**2 increasing with the amplitudes fixed at their limits.
+        #Otherwise (numerically), the best solution with no negative amplitudes of all subsets.
+        pending = np.flatnonzero((x[0] < 0) | (x[1] < 0) | (x[2] < 0) | (x[3] < 0))
+        if len(pending):
+            idx = np.unravel_index(pending, full)
+            flat_index = {full: pending}
+            def take(a):
+                #elements of the broadcast array a at the pending combinations
+                if a.shape not in flat_index:
+                    i = np.zeros(len(pending), dtype=int)
+                    for d, n in enumerate(a.shape):
+                        if n > 1:
+                            i = i*n + idx[d]
+                    flat_index[a.shape] = i
+                return a.take(flat_index[a.shape])
+            for k in range(4):
+                x[k][pending] = 0.
+            chi2[pending] = np.inf
+            AAs = symmetric(lambda k, l: take(AA[k][l]))
+            bs = [take(v) for v in b]
+            c0s = take(c0)
+            for free in sorted(SUBSETS, key=lambda free: -self.optimal[tuple(free)]):
+                if free:
+                    xf, bxf = solve_subset(AAs, bs, free)
+                    chi2s = c0s - bxf
+                    feasible = np.all(np.array(xf) >= 0, axis=0)
+                else:
+                    xf, chi2s = [], c0s
+                    feasible = np.ones(len(pending), dtype=bool)
+                better = feasible & (chi2s < chi2[pending])
+                chi2[pending[better]] = chi2s[better]
+                for i, k in enumerate(free):
+                    x[k][pending[better]] = xf[i][better]
+
+                fixed = [k for k in range(4) if k not in free]
+                optimal = feasible
+                for j in fixed:
+                    grad = bs[j] - sum(AAs[j][k]*xf[i] for i, k in enumerate(free))
+                    optimal = optimal & (grad <= 1e-9*(np.abs(bs[j]) + 1.))
+                if optimal.any():
+                    # (optimal implies better, as the optimum has the lowest chi**2)
+                    self.optimal[tuple(free)] += np.count_nonzero(optimal)
+                    keep = ~optimal
+                    pending = pending[keep]
+                    if not len(pending):
+                        break
+                    AAs = symmetric(lambda k, l: AAs[k][l][keep])
+                    bs = [v[keep] for v in bs]
+                    c0s = c0s[keep]
+
+        #priors on the amplitudes
+        x = [v.reshape(full) for v in x]
+        bad = ~self._axis(2, self.gal_valid, block) | (x[2] > self._axis(2, self.xmax_B, block))
+        for k in range(4):
+            bad = bad | (x[k] >= self._axis(k, self.xmax[k], block))
+        chi2 = chi2.reshape(full)
+        chi2[bad] = np.inf
+
+        return chi2
+
+    def blocks(self, size):
+
+        """Blocks of sources, galaxy and starburst templates (index arrays) of about size
+        elements (sources x combinations), with as many sources as fit."""
+
+        n, (ngal, nsb) = self.nsources, self.shape[:2]
+        nrest = self.shape[2]*self.shape[3]
+        ns = max(1, min(nsb, size // nrest))
+        nsrc = max(1, min(n, size // (ns*nrest)))
+        ng = max(1, min(ngal, size // (nsrc*ns*nrest)))
+        for i in range(0, n, nsrc):
+            for j in range(0, ngal, ng):
+                for k in range(0, nsb, ns):
+                    yield (np.arange(i, min(i+nsrc, n)), np.arange(j, min(j+ng, ngal)),
+                           np.arange(k, min(k+ns, nsb)))
+
+    def scan(self, ndraws=0, rstate=np.random, size=2**16):
+
+        """Computes the chi**2 of all combinations for all sources, in blocks (blocks).
+        Returns, for each source, the log of the posterior summed over the combinations
+        of each galaxy template, the minimal chi**2, the flat index of its combination, the
+        dictionary of the log of the marginal posteriors over the grid values of each parameter,
+        and ndraws draws from the posterior (flat indices and ln posterior, or None)."""
+
+        n = self.nsources
+        chi2_min = np.full(n, np.inf)
+        best = np.zeros(n, dtype=int)
+        lnmarg = [np.full((n, m), -np.inf) for m in self.shape]
+        draws = [(np.zeros(ndraws, dtype=int), np.zeros(ndraws)) for i in range(n)]
+        lnZ = np.full(n, -np.inf)
+
+        for block in self.blocks(size):
+            src, g, s = block
+            chi2 = self.chi2(block)
+            flat = chi2.reshape(len(src), -1)
+            j = flat.argmin(axis=1)
+            jmin = flat[np.arange(len(src)), j]
+            jbest = np.ravel_multi_index((g[0],s[0],0,0), self.shape) + \
+                    np.ravel_multi_index(np.unravel_index(j, chi2.shape[1:]), self.shape)
+            new = jmin < chi2_min[src]
+            chi2_min[src[new]], best[src[new]] = jmin[new], jbest[new]
+
+            #posterior relative to the best combination of each source in the block
+            lnp_max = np.where(np.isfinite(jmin), -0.5*jmin, 0.)
+            p = np.exp(-0.5*chi2 - lnp_max[:,None,None,None,None])
+            with np.errstate(divide='ignore'):
+                for a, idx in enumerate((g, s, np.arange(self.shape[2]), np.arange(self.shape[3]))):
+                    lnp = np.log(p.sum(axis=tuple(b+1 for b in range(4) if b != a))) + lnp_max[:,None]
+                    lnmarg[a][src[:,None], idx] = np.logaddexp(lnmarg[a][src[:,None], idx], lnp)
+                lnZ_block = np.log(p.reshape(len(src), -1).sum(axis=1)) + lnp_max
+            if not ndraws:
+                continue
+            for i, source in enumerate(src):
+                if not np.isfinite(lnZ_block[i]):
+                    continue
+                lnZ[source] = np.logaddexp(lnZ[source], lnZ_block[i])
+                k = rstate.binomial(ndraws, np.exp(lnZ_block[i] - lnZ[source]))
+                pi = p[i].ravel()
+                pick = rstate.choice(len(pi), k, p=pi/pi.sum())
+                slots = rstate.choice(ndraws, k, replace=False)
+                draws[source][0][slots] = np.ravel_multi_index((g[0],s[0],0,0), self.shape) + \
+                                          np.ravel_multi_index(np.unravel_index(pick, chi2.shape[1:]), self.shape)
+                draws[source][1][slots] = -0.5*flat[i, pick]
+
+        logZ = lnmarg[0]
+        gal = logZ.reshape((n,) + self.gal_shape)
+        lnmarg = dict(tau=np.logaddexp.reduce(gal, axis=(2,3)), age=np.logaddexp.reduce(gal, axis=(1,3)),
+                      EBVgal=np.logaddexp.reduce(gal, axis=(1,2)),
+                      irlum=lnmarg[1], EBVbbb=lnmarg[2], Nh=lnmarg[3])
+
+        return logZ, chi2_min, best, lnmarg, (draws if ndraws else None)
+
+    def combination(self, flat_index):
+
+        """Template parameter values, in the order of P.nonlinear, of the combinations
+        with index flat_index in the flattened arrays of shape (ngal, nsb, nbbb, ntor)."""
+
+        g, s, bb, t = np.unravel_index(flat_index, self.shape)
+        ta, a, e = np.unravel_index(g, self.gal_shape)
+        v = self.values
+        return np.array([v['tau'][ta], v['age'][a], v['Nh'][t], v['irlum'][s],
+                         v['EBVbbb'][bb], v['EBVgal'][e]]).T
+
+
+
+def template_products(templates, lnlikes):
+
+    """Scalar products of the templates of the four amplitudes (SB, BB, GA, TO) between
+    each other and with the data, weighted by LIKELIHOOD_KERNEL, for several sources
+    with the same templates, normalised (the products of each with itself are 1).
+
+    ##input:
+    - templates, list of arrays (ntemplates, nbands)
+    - lnlikes, list of LIKELIHOOD_KERNEL of the sources
+
+    ##output:
+    - the norms of the templates (list of arrays (nsources, ntemplates)), the matrix AA
+      of the products of the templates (arrays (nsources, ntemplates_k, ntemplates_l),
+      only the diagonal for the same amplitude), the products Ay with the data, and the
+      products yy of the data with themselves (array (nsources))
+    """
+
+    nbands = templates[0].shape[1]
+    W = np.zeros((len(lnlikes), nbands))
+    Wy = np.zeros((len(lnlikes), nbands))
+    for s, lnlike in enumerate(lnlikes):
+        W[s, lnlike.x_valid] = lnlike.invvar
+        Wy[s, lnlike.x_valid] = lnlike.y*lnlike.invvar
+    yy = np.array([np.dot(lnlike.y**2, lnlike.invvar) for lnlike in lnlikes])
+
+    norm = [np.sqrt(np.dot(W, (t**2).T)) for t in templates]
+    for n in norm:
+        n[n == 0] = 1.
+    Ay = [np.dot(Wy, t.T)/n for t, n in zip(templates, norm)]
+    AA = [[None]*4 for k in range(4)]
+    for k in range(4):
+        AA[k][k] = np.dot(W, (templates[k]**2).T)/norm[k]**2
+        for l in range(k+1, 4):
+            tt = (templates[k][:,None,:]*templates[l][None,:,:]).reshape(-1, nbands)
+            M = np.dot(W, tt.T).reshape(len(lnlikes), len(templates[k]), len(templates[l]))
+            AA[k][l] = M/(norm[k][:,:,None]*norm[l][:,None,:])
+            AA[l][k] = AA[k][l].swapaxes(1, 2)
+
+    return norm, AA, Ay, yy
+
+
+
+# subsets of free amplitudes with negative amplitudes in the unconstrained solution, largest first
+SUBSETS = sorted([[k for k in range(4) if (subset >> k) & 1] for subset in range(2**4 - 1)],
+                 key=len, reverse=True)
+
+
+
+def symmetric(f):
+
+    """Symmetric 4x4 matrix, as lists, of the elements f(k, l) for k <= l."""
+
+    M = [[None]*4 for k in range(4)]
+    for k in range(4):
+        for l in range(k, 4):
+            M[k][l] = M[l][k] = f(k, l)
+    return M
+
+
+
+def solve_subset(A, b, free):
+
+    """Solves A_FF x_F = b_F for the subset F of free amplitudes, with the matrix A
+    and b given as lists of arrays (one element per combination of templates),
+    through the Cholesky decomposition written out element by element.
+    Returns the list x_F and b_F.x_F (the decrease of chi**2)."""
+
+    k = len(free)
+    L = [[None]*k for i in range(k)]
+    for i in range(k):
+        for j in range(i+1):
+            s = A[free[i]][free[j]]
+            for m in range(j):
+                s = s - L[i][m]*L[j][m]
+            if i == j:
+                #the diagonal is 1 (normalised templates), a tiny ridge keeps it positive
+                L[i][i] = np.sqrt(np.maximum(s + 1e-12, 1e-12))
+            else:
+                L[i][j] = s/L[j][j]
+
+    z = []
+    for i in range(k):
+        s = b[free[i]]
+        for m in range(i):
+            s = s - L[i][m]*z[m]
+        z.append(s/L[i][i])
+
+    x = [None]*k
+    for i in reversed(range(k)):
+        s = z[i]
+        for m in range(i+1, k):
+            s = s - L[m][i]*x[m]
+        x[i] = s/L[i][i]
+
+    return x, sum(zi**2 for zi in z)
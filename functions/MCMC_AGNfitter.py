@@ -13,6 +13,7 @@ This script contains
 import emcee #Author: Dan Foreman-Mackey (danfm@nyu.edu)
 import sys,os
 import time
+import multiprocessing
 import numpy as np
 import cPickle
 import PARAMETERSPACE_AGNfitter as parspace
@@ -20,7 +21,7 @@ from DATA_AGNfitter import DATA
 
 
 
-def main(data, P, mc):
+def main(data, P, mc, resume=False):
 
     """
     Main function for the MCMC sampling.
@@ -31,6 +32,8 @@ def main(data, P, mc):
     - object data of class DATA (DATA_AGNfitter.py)
     - dictionary P, of parameter settings (PARAMETERSPACE_AGNfitter.py)
     - dictionary mc, of mcmc settings (RUN_AGNfitter_multi.py)
+    - resume, True to continue from the last checkpoint of the source
+      (mc['checkpoint']), if there is one
     """
 
     path = os.path.abspath(__file__).rsplit('/', 1)[0]
@@ -44,35 +47,95 @@ def main(data, P, mc):
 
     Npar = len(P.names)
 
-
-    sampler = emcee.EnsembleSampler(
-            mc['Nwalkers'], Npar, parspace.ln_probab,
-            args=[data, P],  daemon= True)
+    #settings of earlier versions may lack the keys of the sampler options
+    threads, threadpool = mc.get('threads', 1), mc.get('threadpool', False)
+    vectorize, marginalise = mc.get('vectorize', False), mc.get('marginalise_amplitudes', False)
+    if threads > 1 and not threadpool and multiprocessing.current_process().daemon:
+        #the processes of the catalog pool (--ncpu) cannot have processes of their own
+        print 'Note: fitting in a process of the catalog pool, the %i threads of the sampler' % threads, \
+              'share the posterior evaluations as a pool of threads (threadpool).'
+        threadpool = True
+
+    if marginalise:
+        #sample only the template parameters, the amplitudes are fitted for each proposal
+        #and added to the saved chains afterwards
+        sampled = list(P.nonlinear)
+        expand = lambda chain: parspace.add_amplitudes(chain, data, P)
+        print 'sampling', [P.names[i] for i in sampled], '(amplitudes marginalised)'
+        sampler = emcee.EnsembleSampler(
+                mc['Nwalkers'], len(sampled), parspace.ln_probab_marginalised,
+                args=[data, P],  daemon= True, vectorize=vectorize, threads=threads,
+                threadpool=threadpool)
+
+    elif vectorize:
+        #evaluate the posterior for all walkers of a sub-ensemble in one call
+        sampler = emcee.EnsembleSampler(
+                mc['Nwalkers'], Npar, parspace.ln_probab_batch,
+                args=[data, P],  daemon= True, vectorize=True, threads=threads,
+                threadpool=threadpool)
+    else:
+        sampler = emcee.EnsembleSampler(
+                mc['Nwalkers'], Npar, parspace.ln_probab,
+                args=[data, P],  daemon= True, threads=threads,
+                threadpool=threadpool)
+
+    if not marginalise:
+        sampled = range(Npar)
+        expand = None
+
+    #the chains are saved in the precision of the model dictionary
+    dtype = data.dict_modelfluxes['STARBURST'].dtype
+
+    checkpointfile = data.output_folder+str(data.name)+'/checkpoint.sav'
+    checkpoint = load_checkpoint(checkpointfile) if resume else None
+    phase = 'burn-in' if checkpoint is None else checkpoint['phase']
+    if phase == 'done':
+        print 'The sampling of this source was finished, nothing to resume.'
+    elif checkpoint is not None:
+        print 'Resuming the %s from step %i' % (phase, checkpoint['step'])
+    p_maxlike = None
 
 
     ## BURN-IN SETS ##
-    if mc['Nburn'] > 0:
+    if mc['Nburn'] > 0 and phase == 'burn-in':
 
         t1 = time.time()
         if not os.path.lexists(data.output_folder+str(data.name)):
             os.mkdir(data.output_folder+str(data.name))
 
-        p_maxlike = parspace.get_initial_positions(mc['Nwalkers'], P)
+        if checkpoint is None:
+            p_maxlike = parspace.get_initial_positions(mc['Nwalkers'], P)[:,sampled]
+            first = 0
+        else:
+            first = checkpoint['setnr']
+        p_maxlike, lnprob, start = start_chains(sampler, mc, data.output_folder+str(data.name)+'/samples_burn1-2-3', 
+                                                p_maxlike, dtype, checkpoint)
         Nr_BurnIns = mc['Nburnsets']  
 
-        for i in range(Nr_BurnIns):
-            p_maxlike, state = run_burn_in(sampler, mc, p_maxlike, data.name, data.output_folder, i)
+        parspace.reset_counts(P)
+        for i in range(first, Nr_BurnIns):
+            p_maxlike, state = run_burn_in(sampler, mc, p_maxlike, data.name, data.output_folder, i, expand, dtype, lnprob, start)
+            lnprob, start = None, 0
             savedfile = data.output_folder+str(data.name)+'/samples_burn1-2-3.sav'
-            p_maxlike = parspace.get_best_position(savedfile, mc['Nwalkers'], P)
+            p_maxlike = parspace.get_best_position(savedfile, mc['Nwalkers'], P)[:,sampled]
+        parspace.print_counts(P)
         print '%.2g min elapsed' % ((time.time() - t1)/60.)
 
 
     ## MCMC SAMPLING ##
-    if mc['Nmcmc'] > 0:
+    if mc['Nmcmc'] > 0 and phase != 'done':
 
         t2 = time.time()
-        run_mcmc(sampler, p_maxlike, data.name,data.output_folder, mc)
+        parspace.reset_counts(P)
+        run_mcmc(sampler, p_maxlike, data.name,data.output_folder, mc, expand, dtype, 
+                 checkpoint if phase == 'mcmc' else None)
+        parspace.print_counts(P)
         print '%.2g min elapsed' % ((time.time() - t2)/60.)
+
+    if mc.get('checkpoint', 0) > 0 and phase != 'done':
+        save_checkpoint(checkpointfile, phase='done')
+    if sampler.pool is not None:
+        sampler.pool.terminate()
     del sampler.pool    
 
 
@@ -86,43 +149,157 @@ if __name__ == 'main':
 =================================================="""
 
 
-def run_burn_in(sampler, mc, p0, sourcename, folder, setnr):
-    """ Run and save a set of burn-in iterations."""
+def run_burn_in(sampler, mc, p0, sourcename, folder, setnr, expand=None, dtype=float, lnprob0=None, start=0):
+    """ Run and save a set of burn-in iterations (from step start, when resumed)."""
 
     print 'Running burn-in nr. '+ str(setnr)+' with %i steps' % mc['Nburn']
     
-    iprint = mc['iprint']
-
     # note the results are saved in the sampler object.
-    for i,(pos, lnprob, state) in enumerate(sampler.sample(p0, iterations=mc['Nburn'])):
-        i += 1
-        if not i % iprint:
-            print i
+    pos, state, _ = run_steps(sampler, p0, lnprob0, start, mc['Nburn'], mc, 
+                           folder+str(sourcename)+'/checkpoint.sav', phase='burn-in', setnr=setnr)
         
-    save_chains(folder+str(sourcename)+'/samples_burn1-2-3.sav', sampler, pos, state)
+    save_chains(folder+str(sourcename)+'/samples_burn1-2-3.sav', sampler, pos, state, expand, dtype)
 
     return pos, state   
 
 
-def run_mcmc(sampler, pburn, sourcename, folder, mc):
+def run_mcmc(sampler, pburn, sourcename, folder, mc, expand=None, dtype=float, checkpoint=None):
     """
     Run MCMC sampling and save.    
+    With a checkpoint of the MCMC phase (load_checkpoint), continue from it.
+    With mc['acor_every'] > 0, stop before mc['Nmcmc'] steps once the chains 
+    are long enough for their autocorrelation time (autocorr_stop), and save 
+    the reason of the stop.
     """
 
-    sampler.reset()
+    p0, lnprob0, start = start_chains(sampler, mc, folder+str(sourcename)+'/samples_mcmc', pburn, dtype, checkpoint)
 
-    iprint = mc['iprint']
     print "Running MCMC with %i steps" % mc['Nmcmc']
 
-    for i,(pos, lnprob, state) in enumerate(sampler.sample(pburn, iterations=mc['Nmcmc'])): 
-        i += 1
+    stop = None
+    if mc.get('acor_every', 0) > 0:
+        stop = lambda chain: autocorr_stop(chain, mc)
+    pos, state, reason = run_steps(sampler, p0, lnprob0, start, mc['Nmcmc'], mc, 
+                                   folder+str(sourcename)+'/checkpoint.sav', stop, phase='mcmc')
+    if mc.get('acor_every', 0) > 0 and reason is None:
+        reason = 'not converged within Nmcmc = %i steps' % mc['Nmcmc']
+    if reason is not None:
+        print 'MCMC ' + reason
+            
+    save_chains(folder+str(sourcename)+'/samples_mcmc.sav', sampler, pos, state, expand, dtype, reason)   
+
+
+def run_steps(sampler, p0, lnprob0, start, iterations, mc, checkpointfile, stop=None, **phase):
+    """
+    Advance the sampler from step start to step iterations of a phase,
+    from the positions p0 (with their lnprob0, or None), and print the
+    progress every mc['iprint'] steps.
+    With mc['checkpoint'] > 0, a checkpoint is saved every mc['checkpoint'] steps.
+    If given, stop(chain) is called with the chain of the phase every 
+    mc['acor_every'] steps, and returns the reason to stop there, or None.
+    Returns the last positions, random state and reason of an early stop.
+    """
+    iprint, every = mc['iprint'], mc.get('checkpoint', 0)
+
+    if every > 0 and start == 0:
+        save_checkpoint(checkpointfile, sampler, p0, lnprob0, step=0, **phase)
+
+    reason = None
+    for i,(pos, lnprob, state) in enumerate(sampler.sample(p0, lnprob0, iterations=iterations-start), start+1):
         if not i % iprint:
             print i
-            
-    save_chains(folder+str(sourcename)+'/samples_mcmc.sav', sampler, pos, state)   
+        if stop is not None and not i % mc.get('acor_every', 0) and i < iterations:
+            reason = stop(sampler.chain)
+            if reason is not None:
+                break
+        if every > 0 and not i % every and i < iterations:
+            save_checkpoint(checkpointfile, sampler, pos, lnprob, step=i, **phase)
+
+    return pos, state, reason
+
+
+def autocorr_time(chain):
+    """
+    Integrated autocorrelation time of each parameter of the chain 
+    (nwalkers, nsteps, npar), estimated with the acor module as sampler.acor,
+    or inf where the chain is too short for the estimate.
+    """
+    import acor
+    tau = np.empty(chain.shape[-1])
+    for i in range(len(tau)):
+        try:
+            tau[i] = acor.acor(np.array(chain[:, :, i]))[0]
+        except RuntimeError:
+            tau[i] = np.inf
+    return tau
+
+
+def autocorr_stop(chain, mc):
+    """
+    Stopping rule of the MCMC phase: returns the reason to stop, if the chain is
+    longer than mc['acor_factor'] times the largest autocorrelation time tau and tau
+    changed by less than mc['acor_tolerance'] over the last mc['acor_every'] steps, or None.
+    """
+    nsteps, every = chain.shape[1], mc.get('acor_every', 0)
+    if nsteps < 2*every:
+        return None
+    tau, previous = autocorr_time(chain), autocorr_time(chain[:, :nsteps-every])
+    with np.errstate(invalid='ignore'):
+        change = np.max(np.abs(tau - previous) / tau)
+    if nsteps > mc.get('acor_factor', 50) * tau.max() and change < mc.get('acor_tolerance', 0.01):
+        return 'converged after %i steps (%.1f times the autocorrelation time %.1f, which changed by %.2g%%)' \
+               % (nsteps, nsteps / tau.max(), tau.max(), 100*change)
+    return None
+
+
+def start_chains(sampler, mc, filename, p0, dtype=float, checkpoint=None):
+    """
+    Start the chains of a phase (burn-in or MCMC) from the positions p0,
+    resetting the sampler, or continue them from a checkpoint of the phase.
+    With mc['chain_window'] > 0, the steps are streamed to files (emcee.backends.ChainFile).
+    Returns the positions, their lnprob (None if unknown) and the step
+    of the phase to start from.
+    """
+    window = mc.get('chain_window', 0)
+    if window > 0:
+        sampler.backend = emcee.backends.ChainFile(filename, window, dtype)
+    if checkpoint is None:
+        sampler.reset()
+        return p0, None, 0
+    p, lnprob = sampler.restore(checkpoint['sampler'])
+    return p, lnprob, checkpoint['step']
+
+
+def save_checkpoint(filename, sampler=None, pos=None, lnprob=None, **phase):
+    """
+    Save the phase (e.g. phase='mcmc' with step), the state of the sampler
+    at the positions pos and the state of np.random into a .sav file, using
+    cPickle, to resume the sampling at this point (load_checkpoint).
+    """
+    checkpoint = dict(np_state=np.random.get_state(), **phase)
+    if sampler is not None:
+        checkpoint['sampler'] = sampler.checkpoint(pos, lnprob)
+    f = open(filename+'.tmp', 'wb')
+    cPickle.dump(checkpoint, f, protocol=2)
+    f.close()
+    os.rename(filename+'.tmp', filename)
+
+
+def load_checkpoint(filename):
+    """
+    Load the checkpoint saved by save_checkpoint and restore the state
+    of np.random. Returns None if there is no checkpoint.
+    """
+    if not os.path.lexists(filename):
+        return None
+    f = open(filename, 'rb')
+    checkpoint = cPickle.load(f)
+    f.close()
+    np.random.set_state(checkpoint['np_state'])
+    return checkpoint
 
 
-def save_chains(filename, sampler, pos, state):
+def save_chains(filename, sampler, pos, state, expand=None, dtype=float, stop=None):
     """
     Save dictionary which contains:
     -chains
@@ -131,11 +308,30 @@ def save_chains(filename, sampler, pos, state):
     -last positions
     -autocorrelation time 
     into .sav files, using cPickle.
+    If given, expand(chain) constructs the chains of all parameters
+    from the sampled ones (for marginalised amplitudes).
+    The chains, lnprob and last positions are saved with the given dtype.
+    Chains streamed to files (start_chains) are saved as their name ('chainfile').
+    If given, the reason why the sampling stopped is saved as 'stop'.
     """
+    if sampler.backend is not None:
+        chainfile = sampler.backend
+        if expand is not None:
+            chainfile = chainfile.transformed(chainfile.filename+'_all', expand)
+            pos = expand(np.asarray(pos))
+        saved = dict(chainfile=os.path.basename(chainfile.filename))
+    else:
+        chain = sampler.chain
+        if expand is not None:
+            chain, pos = expand(chain), expand(np.asarray(pos))
+        saved = dict(chain=chain.astype(dtype, copy=False),
+                     lnprob=sampler.lnprobability.astype(dtype, copy=False))
+    if stop is not None:
+        saved['stop'] = stop
     f = open(filename, 'wb')
     cPickle.dump(dict(
-        chain=sampler.chain, accept=sampler.acceptance_fraction,
-        lnprob=sampler.lnprobability, final_pos=pos, state=state, acor=sampler.acor), f, protocol=2)
+        accept=sampler.acceptance_fraction, final_pos=np.asarray(pos, dtype=dtype),
+        state=state, acor=sampler.acor, **saved), f, protocol=2)
     f.close()
 
 
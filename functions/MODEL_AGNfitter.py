@@ -15,6 +15,8 @@ pick_STARBURST_template
 pick_GALAXY_template
 pick_TORUS_template
 pick_EBV_grid
+GRID_INDEX
+TEMPLATE_INDEX
 
 
 STARBURST_nf
@@ -25,7 +27,8 @@ TORUS_nf
 """
 
 import numpy as np
-from math import exp,pi, sqrt
+from math import exp,pi, sqrt, floor
+from bisect import bisect_left
 import matplotlib.pyplot as plt
 import time
 from scipy.interpolate import interp1d
@@ -41,33 +44,135 @@ PICKING TEMPLATES
 ==============================
 
 Functions which compensate for the discreteness of pur models. 
-It infers the existent model dictionary key 'par_key',
-from the continous valus par_mcmc, through NearestNeighbour interpolation.
+They infer the index of the existent model grid value (par_dict),
+nearest to the continous valus par_mcmc, through NearestNeighbour interpolation.
+The pick_*_template functions accept either single values or arrays of 
+values (one per walker), and return the index(es) with the same shape.
+
+The grids are sorted, so the nearest node is found by bisection (searchsorted),
+or directly by arithmetic if the grid is uniformly spaced (GRID_INDEX).
+As with argmin, the lower node is chosen if the value lies exactly halfway.
 
 """
 
 
+def nearest_index(grid, x, idx=None):
+
+    """
+    Index of the node of the sorted array grid nearest to x.
+    x can be a single value or an array.
+    idx optionally gives the position of x in grid, as from searchsorted.
+    """
+
+    if len(grid) == 1:
+        return np.zeros(np.shape(x), dtype=int)
+    if idx is None:
+        idx = np.searchsorted(grid, x)
+    idx = np.clip(idx, 1, len(grid)-1)
+    lower = grid[idx-1]
+    upper = grid[idx]
+    return np.where(x - lower <= upper - x, idx-1, idx)
+
+
+class GRID_INDEX:
+
+    """
+    Class GRID_INDEX
+
+    Nearest-node lookup on a sorted grid of parameter values of the models
+    (arithmetic on uniform grids, bisection otherwise).
+
+    ##input:
+    - array of grid values (sorted, increasing)
+    """
+
+    def __init__(self, grid):
+
+        self.grid = np.asarray(grid, dtype=float)
+        self.gridlist = self.grid.tolist()
+        self.n = len(self.grid)
+        steps = np.diff(self.grid)
+        self.uniform = self.n > 1 and np.allclose(steps, steps[0], rtol=1e-6, atol=0.)
+        if self.uniform:
+            self.x0 = self.grid[0]
+            self.dx = (self.grid[-1] - self.grid[0])/(self.n-1)
+
+    def index(self, x):
+
+        if np.ndim(x) == 0:
+            return self.index_scalar(float(x))
+        if self.uniform:
+            x = np.asarray(x, dtype=float)
+            idx = np.floor(np.clip((x - self.x0)/self.dx, -1., self.n)).astype(int) + 1
+            return nearest_index(self.grid, x, idx)
+        return nearest_index(self.grid, x)
+
+    def index_scalar(self, x):
+
+        #same as index, avoiding the overhead of numpy for single values
+        grid = self.gridlist
+        if self.n == 1:
+            return 0
+        if self.uniform:
+            t = min(max((x - self.x0)/self.dx, -1.), float(self.n)) if x == x else 0.
+            i = int(floor(t)) + 1
+        else:
+            i = bisect_left(grid, x)
+        i = min(max(i, 1), self.n-1)
+        return i-1 if x - grid[i-1] <= grid[i] - x else i
+
+
+class TEMPLATE_INDEX:
+
+    """
+    Class TEMPLATE_INDEX
+
+    Maps parameter values to the indices of the nearest templates in the 
+    model arrays of one redshift (see DICTIONARIES_AGNfitter.dictkey_arrays).
+
+    ##input:
+    - parameter grids: tau, age [yr], ebvgal, irlum, nh, ebvbbb
+    - array of the galaxy SFRs [tau, age]
+    """
+
+    def __init__(self, tau, age, ebvgal, irlum, nh, ebvbbb, SFR):
+
+        self.tau = GRID_INDEX(tau)
+        self.age = GRID_INDEX(age)
+        self.ebvgal = GRID_INDEX(ebvgal)
+        self.irlum = GRID_INDEX(irlum)
+        self.nh = GRID_INDEX(nh)
+        self.ebvbbb = GRID_INDEX(ebvbbb)
+        self.SFR = SFR
+
+    def GALAXY(self, tau, age, ebvg):
+        return self.tau.index(tau), self.age.index(age), self.ebvgal.index(ebvg)
+
+    def STARBURST(self, irlum):
+        return self.irlum.index(irlum)
+
+    def TORUS(self, nh):
+        return self.nh.index(nh)
+
+    def BBB(self, ebvb):
+        return self.ebvbbb.index(ebvb)
+
+
 def pick_STARBURST_template(ir_lum, irlum_dict):
 
-    idx = (np.abs(irlum_dict.astype(float)-ir_lum)).argmin()
-    return irlum_dict[idx]
+    return nearest_index(irlum_dict, ir_lum)
 
 def pick_BBB_template(ebvb,ebvb_dict):
     
-    ebvb_idx = (np.abs(ebvb_dict.astype(float)-ebvb)).argmin()
-    return ebvb_dict[ebvb_idx]
+    return nearest_index(ebvb_dict, ebvb)
 
 def pick_GALAXY_template( tau, age, ebvg, tau_dict, age_dict, ebvg_dict):
-    tauidx = (np.abs(tau_dict.astype(float)-tau)).argmin()    
-    ageidx = (np.abs(age_dict.astype(float)-age)).argmin()
-    ebvidx = (np.abs(ebvg_dict.astype(float)-ebvg)).argmin()
 
-    return tau_dict[tauidx], age_dict[ageidx], ebvg_dict[ebvidx]
+    return nearest_index(tau_dict, tau), nearest_index(age_dict, age), nearest_index(ebvg_dict, ebvg)
 
 def pick_TORUS_template(nh, nh_dict):
 
-    idx = (np.abs(nh_dict.astype(float)-nh)).argmin()
-    return nh_dict[idx]
+    return nearest_index(nh_dict, nh)
 
 def pick_EBV_grid (EBV_array, EBV):
 
@@ -237,7 +342,7 @@ def stellar_info(chain, data):
     computes stellar masses and SFRs
     """
 
-    gal_do,  irlum_dict, nh_dict, BBebv_dict, SFRdict = data.dictkey_arrays #call dictionary info
+    template_index = data.dictkey_arrays #call dictionary info
 
     #relevanta parameters form the MCMC chain
     tau_mcmc = chain[:,0]     
@@ -251,26 +356,18 @@ def stellar_info(chain, data):
     solarlum = const.L_sun.to(u.erg/u.second) #3.839e33
     solarmass = const.M_sun
 
-    Mstar_list=[]
-    SFR_list=[]
-
-
-    for i in range (len (tau_mcmc)):        
-        N = 10**GA[i]* 4* pi* distance**2 / (solarlum.value)/ (1+z)
+    N = 10**GA* 4* pi* distance**2 / (solarlum.value)/ (1+z)
 
-        gal_do.nearest_par2dict(tau_mcmc[i], 10**age_mcmc[i], 0.)
-        tau_dct, age_dct, ebvg_dct=gal_do.t, gal_do.a,gal_do.e
-        SFR_mcmc =SFRdict[tau_dct, age_dct]
+    tau_dct, age_dct, ebvg_dct = template_index.GALAXY(tau_mcmc, 10**age_mcmc, 0.)
+    SFR_mcmc = template_index.SFR[tau_dct, age_dct] # [Msun/yr]
 
-        # Calculate Mstar. BC03 templates are normalized to M* = 1 M_sun. 
-        # Thanks to Kenneth Duncan, and his python version of BC03, smpy
-        Mstar = np.log10(N * 1) 
-        #Calculate SFR. output is in [Msun/yr]. 
-        SFR = N * SFR_mcmc
-        SFR_list.append(SFR.value)    
-        Mstar_list.append(Mstar)    
+    # Calculate Mstar. BC03 templates are normalized to M* = 1 M_sun. 
+    # Thanks to Kenneth Duncan, and his python version of BC03, smpy
+    Mstar = np.log10(N * 1) 
+    #Calculate SFR. output is in [Msun/yr]. 
+    SFR = N * SFR_mcmc
 
-    return np.array(Mstar_list)    , np.array(SFR_list)
+    return Mstar, SFR
 
 
 def stellar_info_array(chain_flat, data, Nthin_compute):
@@ -376,6 +473,89 @@ def filters1( model_nus, model_fluxes, filterdict, z ):
     return bands, np.array(filtered_model_Fnus)
 
 
+def filters_matrix(model_nus, filterdict, z):
+
+    """
+    Matrix of the projection of filters1 (linear in the model fluxes) for templates
+    on the frequencies model_nus.
+
+    ##input:
+    - model_nus: template frequencies [log10(nu)]
+    - filterdict, z (see filters1)
+
+    ##output:
+    - bands [log10(nu)]
+    - matrix (len(model_nus), nbands), the filtered fluxes being np.dot(model_fluxes, matrix)
+    """
+
+    bands, files_dict, lambdas_dict, factors_dict = filterdict
+    n = len(model_nus)
+
+    # template wavelengths in the observed frame, in increasing order as in filters1,
+    # and the index of the nearest one at each wavelength (-1 outside of the template)
+    model_lambdas = (nu2lambda_angstrom(np.asarray(model_nus)) * (1+z))[::-1]
+    nearest = interp1d(model_lambdas, np.arange(n), kind = 'nearest', bounds_error=False, fill_value=-1)
+
+    matrix = np.zeros((n, len(bands)))
+    for b, iband in enumerate(bands):
+
+        lambdas_filter = np.array(lambdas_dict[iband]).ravel()
+        factors_filter = np.array(factors_dict[iband]).ravel()
+        iband_angst = nu2lambda_angstrom(iband)
+
+        # weights of the trapezoidal rule
+        dlambdas = np.diff(lambdas_filter)
+        weights = np.zeros(len(lambdas_filter))
+        weights[:-1] += 0.5*dlambdas
+        weights[1:] += 0.5*dlambdas
+        weights *= factors_filter / trapz(factors_filter, x= lambdas_filter)
+
+        idx = nearest(lambdas_filter).astype(int)
+        inside = idx >= 0
+        idx = idx[inside]
+        column = np.zeros(n)
+        np.add.at(column, n-1-idx, weights[inside] * fluxnu_2_fluxlambda(1., model_lambdas[idx]))
+        matrix[:, b] = fluxlambda_2_fluxnu(column, iband_angst)
+
+    return bands, matrix
+
+
+
+class FILTER_PROJECTION:
+
+    """
+    Class FILTER_PROJECTION
+
+    Projection of model SEDs into the filter curves of each band (as filters1)
+    at one redshift, with one matrix (filters_matrix) per grid of template frequencies.
+
+    ##input:
+    - filterdict: dictionary with all band filter curves' information
+    - z: redshift
+    """
+
+    def __init__(self, filterdict, z):
+
+        self.filterdict = filterdict
+        self.z = z
+        self.matrices = dict()
+
+    def __call__(self, model_nus, model_fluxes):
+
+        """
+        Filtered fluxes of the templates model_fluxes, array (..., len(model_nus)).
+        Returns the bands and the filtered fluxes, array (..., nbands).
+        """
+
+        key = np.asarray(model_nus, dtype=float).tostring()
+        if key not in self.matrices:
+            self.matrices[key] = filters_matrix(model_nus, self.filterdict, self.z)
+        bands, matrix = self.matrices[key]
+
+        return bands, np.dot(model_fluxes, matrix)
+
+
+
 c = 2.997e8
 
 def fluxlambda_2_fluxnu (flux_lambda, wl_angst):
@@ -17,9 +17,12 @@ import pylab as pl
 import numpy as np
 from math import pi
 import time
+import os
 import pickle
+import threading
+import emcee
 import MODEL_AGNfitter as model
-from DATA_AGNfitter import DATA
+import DICTIONARIES_AGNfitter as dicts
 
 
 def Pdict (data):
@@ -38,16 +41,78 @@ def Pdict (data):
 
     Npar = len(P.names)
 
+    # indices of the amplitudes, on which the model depends linearly,
+    # and of the parameters which pick the templates (see ln_probab_marginalised)
+    P.linear = 4, 5, 6, 7
+    P.nonlinear = 0, 1, 2, 3, 8, 9
+
+    # number of proposals rejected at each stage of the posterior (see ln_probab)
+    P.counts = dict.fromkeys(COUNTS_STAGES, 0)
+
     return P    
 
 
 
+COUNTS_STAGES = 'proposals', 'out_of_bounds', 'lumfct_prior', 'likelihood'
+
+# the counters are the only state written by the posterior functions, which can 
+# thus be called at the same time by the threads of the sampler (mc['threadpool'])
+COUNTS_LOCK = threading.Lock()
+
+def reset_counts(P):
+
+    """Sets the counters of the posterior stages in P to zero."""
+
+    P.counts = dict.fromkeys(COUNTS_STAGES, 0)
+
+
+def add_counts(P, **stages):
+
+    """Adds the numbers of proposals given for each stage (e.g. likelihood=3) 
+    to the counters in P, which are shared by the threads of the sampler."""
+
+    with COUNTS_LOCK:
+        for stage, n in stages.items():
+            P.counts[stage] += n
+
+
+def print_counts(P):
+
+    """Prints how many proposals were rejected at each stage of the posterior,
+    and how many needed the full model and likelihood.
+    The proposals evaluated by the processes of the sampler (mc['threads'] > 1)
+    are counted in these processes, and not here."""
+
+    counts = P.counts
+    if not counts['proposals']:
+        print 'posterior evaluations: counted in the processes of the sampler'
+        return
+    n = max(counts['proposals'], 1)
+    print 'posterior evaluations: %i proposals' % counts['proposals']
+    print '- rejected out of bounds: %i (%.1f%%)' % (counts['out_of_bounds'], 100.*counts['out_of_bounds']/n)
+    print '- rejected by the galaxy luminosity prior: %i (%.1f%%)' % (counts['lumfct_prior'], 100.*counts['lumfct_prior']/n)
+    print '- full model and likelihood: %i (%.1f%%)' % (counts['likelihood'], 100.*counts['likelihood']/n)
+
+
+
 """-------------------------
 PRIOR, LIKELIHOOD, POSTERIOR 
 ---------------------------"""
 
 
-def ln_prior(z, dlum,bands, gal_Fnu, P, pars):
+def in_bounds(P, pars):
+
+    """Flat prior on all parameters considering the limits described in P.
+    ## output: True if all parameters are within the limits."""
+
+    for i,p in enumerate(pars):
+        if not (P.min[i] < p < P.max[i]):
+            return False
+    return True
+
+
+
+def ln_prior(lumfct_prior, gal_Fnu, P, pars):
 
     """Calculates the prior probability on the parameters.
 
@@ -55,19 +120,17 @@ def ln_prior(z, dlum,bands, gal_Fnu, P, pars):
     (2) Flat prior on the galaxy, using the B-band magnitude expected 
          from the galaxy luminosity function as a maximum of the prior.
 
-    ## inputs: z, dlum,bands, gal_Fnu, P, pars
+    ## inputs: lumfct_prior (GALAXY_LUMFCT_PRIOR), gal_Fnu, P, pars
     ## output: -inf or 0.
     """
 
     #1. Flat priors
-    for i,p in enumerate(pars):
-        if not (P.min[i] < p < P.max[i]):
-            return -np.inf
+    if not in_bounds(P, pars):
+        return -np.inf
 
     #2. Prior on the luminosity
-    B_band_expected, B_band_thispoint = galaxy_Lumfct_prior( z, dlum, bands, gal_Fnu)    # Bband expectations
     #if Bband magnitude in this trial is brighter than expected by the luminosity function, dont accept this one
-    if B_band_thispoint < (B_band_expected - 5):#2.5):
+    if not lumfct_prior(gal_Fnu):
         return -np.inf
 
     return 0.
@@ -84,20 +147,49 @@ def ln_likelihood(x, y, ysigma, z, y_model):
 
     ## inputs:
     - x, y, ysigma, z
-    - y_model calculate with fct ymodel()
+    - y_model calculate with fct ymodel(), or an array (nwalkers, nbands)
+      calculated with fct ymodel_batch()
 
     ## output:
-    - (-1 * ln(likelihood))"""
+    - (-1 * ln(likelihood)), one value per model vector"""
     #x_valid:
     #only frequencies with existing data (no detections nor limits F = -99)        
     #Consider only data free of IGM absorption. Lyz = 15.38 restframe        
 
     x_valid = np.arange(len(x))[(x< np.log10(10**(15.38)/(1+z))) & (y>-99.)]
 
-    resid = [(y[i] - y_model[i])/ysigma[i] for i in x_valid]
+    resid = (y[x_valid] - y_model[...,x_valid])/ysigma[x_valid]
 
 
-    return -0.5 * np.dot(resid, resid)
+    return -0.5 * np.sum(resid**2, axis=-1)
+
+
+
+class LIKELIHOOD_KERNEL:
+
+    """
+    Class LIKELIHOOD_KERNEL
+
+    ln_likelihood of one source, with the valid bands and their weights
+    computed once. Called with a model vector, or an array (nwalkers, nbands).
+
+    ##input:
+    - x, y, ysigma, z (see ln_likelihood)
+
+    ## dependencies:
+    - constructed in DATA (DATA_AGNfitter.py), used by ln_probab and ln_probab_batch
+    """
+
+    def __init__(self, x, y, ysigma, z):
+
+        self.x_valid = np.arange(len(x))[(x< np.log10(10**(15.38)/(1+z))) & (y>-99.)]
+        self.y = y[self.x_valid]
+        self.invvar = 1./ysigma[self.x_valid]**2
+
+    def __call__(self, y_model):
+
+        resid = y_model[...,self.x_valid] - self.y
+        return -0.5 * np.dot(resid**2, self.invvar)
 
 
 
@@ -105,6 +197,10 @@ def ln_likelihood(x, y, ysigma, z, y_model):
 def ln_probab(pars, data, P):
 
     """Calculates the posterior probability as Ppos= Pprior + Pdata
+    in stages (flat priors, galaxy luminosity prior, likelihood), returning
+    -inf at the first one which rejects the proposal.
+    The proposals rejected at each stage are counted in P.counts (add_counts).
+
     ## inputs:
     - pars
     - object data
@@ -116,14 +212,287 @@ def ln_probab(pars, data, P):
     ## dependencies:
     - MCMC_AGNfitter.py"""
 
-    y_model, bands, gal_Fnu = ymodel(data.nus,data.z,data.dictkey_arrays,data.dict_modelfluxes,*pars)
+    #1. Flat priors
+    if not in_bounds(P, pars):
+        add_counts(P, proposals=1, out_of_bounds=1)
+        return -np.inf
+
+    tau, agelog, nh, irlum, SB ,BB, GA,TO, BBebv, GAebv= pars[0:10]
+
+    #2. Prior on the luminosity
+    gal_Fnu = ymodel_galaxy(data.dictkey_arrays, data.dict_modelfluxes, tau, agelog, GA, GAebv)
+    if not data.lumfct_prior(gal_Fnu):
+        add_counts(P, proposals=1, lumfct_prior=1)
+        return -np.inf
+
+    #3. Likelihood
+    add_counts(P, proposals=1, likelihood=1)
+    y_model = ymodel_total(data.dictkey_arrays, data.dict_modelfluxes, gal_Fnu, nh, irlum, SB, BB, TO, BBebv)
+
+    return data.lnlike(y_model)
+
+
+
+def ln_probab_batch(pars, data, P):
+
+    """Calculates the posterior probability as Ppos= Pprior + Pdata
+    of all walkers in one call (ln_probab of each row of pars).
+
+    ## inputs:
+    - pars, array of shape (nwalkers, len(P.names))
+    - object data
+    - dictionary P
+
+    ## output:
+    - array of POSTERIOR probabilities, one per walker
+
+    ## dependencies:
+    - MCMC_AGNfitter.py (with emcee.EnsembleSampler(..., vectorize=True))"""
 
-    lnp = ln_prior(data.z, data.dlum, bands,gal_Fnu, P, pars)
+    pars = np.atleast_2d(pars)
+    posterior = np.empty(len(pars))
+    posterior.fill(-np.inf)
+    add_counts(P, proposals=len(pars))
 
-    if np.isfinite(lnp):    
-        posterior = lnp + ln_likelihood(data.nus,data.fluxes,data.fluxerrs, data.z, y_model)     
+    #1. Flat priors
+    inside = np.all((np.array(P.min) < pars) & (pars < np.array(P.max)), axis=1)
+    add_counts(P, out_of_bounds=len(pars) - np.count_nonzero(inside))
+    if not np.any(inside):
         return posterior
-    return -np.inf
+
+    tau, agelog, nh, irlum, SB ,BB, GA,TO, BBebv, GAebv= pars[inside,0:10].T
+
+    #2. Prior on the luminosity
+    gal_Fnu = ymodel_galaxy(data.dictkey_arrays, data.dict_modelfluxes, tau, agelog, GA, GAebv)
+    lumfct_ok = data.lumfct_prior(gal_Fnu)
+    add_counts(P, lumfct_prior=len(lumfct_ok) - np.count_nonzero(lumfct_ok))
+    if not np.any(lumfct_ok):
+        return posterior
+
+    #3. Likelihood
+    add_counts(P, likelihood=np.count_nonzero(lumfct_ok))
+    y_model = ymodel_total(data.dictkey_arrays, data.dict_modelfluxes, gal_Fnu[lumfct_ok], 
+                           nh[lumfct_ok], irlum[lumfct_ok], SB[lumfct_ok], BB[lumfct_ok], 
+                           TO[lumfct_ok], BBebv[lumfct_ok])
+
+    idx = np.arange(len(pars))[inside][lumfct_ok]
+    posterior[idx] = data.lnlike(y_model)
+
+    return posterior
+
+
+"""------------------------------------
+MARGINALISATION OF THE AMPLITUDES
+------------------------------------
+
+The total model is linear in the amplitudes 10**SB, 10**BB, 10**GA, 10**TO.
+For given templates (tau, age, Nh, irlum, EBVbbb, EBVgal), the amplitudes 
+which maximise the likelihood within the limits of P are the solution of a 
+weighted least-squares problem with bounds, which is solved exactly.
+The MCMC then only explores the 6 template parameters, with the posterior
+maximised over the amplitudes (profile posterior). The amplitudes are 
+recovered for the saved chains afterwards (add_amplitudes), so that the 
+outputs have the same 10 parameters as the full sampling.
+"""
+
+
+def ln_probab_marginalised(pars, data, P):
+
+    """Calculates the posterior probability as in ln_probab_batch, for the 
+    template parameters only (P.nonlinear), maximising over the amplitudes.
+
+    ## inputs:
+    - pars, array of shape (nwalkers, len(P.nonlinear)), or one vector
+    - object data
+    - dictionary P
+
+    ## output:
+    - array of POSTERIOR probabilities, one per walker (or a float for one vector)
+
+    ## dependencies:
+    - MCMC_AGNfitter.py, if mc['marginalise_amplitudes']"""
+
+    single = np.ndim(pars) == 1
+    pars = np.atleast_2d(pars)
+    posterior = np.empty(len(pars))
+    posterior.fill(-np.inf)
+    add_counts(P, proposals=len(pars))
+
+    #1. Flat priors on the template parameters
+    Pmin, Pmax = [np.array(lim)[list(P.nonlinear)] for lim in (P.min, P.max)]
+    inside = np.all((Pmin < pars) & (pars < Pmax), axis=1)
+
+    templates = ymodel_templates(data.dictkey_arrays, data.dict_modelfluxes, pars[inside])
+    amplitudes, chi2 = fit_amplitudes(templates, data.lnlike, P)
+
+    #   and on the amplitudes
+    Amax = 10**np.array(P.max)[list(P.linear)]
+    amp_ok = np.all(amplitudes < Amax, axis=-1)
+    add_counts(P, out_of_bounds=len(pars) - np.count_nonzero(amp_ok))
+
+    #2. Prior on the luminosity
+    gal_Fnu = amplitudes[:,2,None]*templates[...,2]
+    lumfct_ok = data.lumfct_prior(gal_Fnu) & amp_ok
+    add_counts(P, lumfct_prior=np.count_nonzero(amp_ok) - np.count_nonzero(lumfct_ok))
+
+    #3. Likelihood
+    add_counts(P, likelihood=np.count_nonzero(lumfct_ok))
+    idx = np.arange(len(pars))[inside][lumfct_ok]
+    posterior[idx] = -0.5 * chi2[lumfct_ok]
+
+    if single:
+        return posterior[0]
+    return posterior
+
+
+
+def ymodel_templates(dictkey_arrays, dict_modelfluxes, pars):
+
+    """Picks the templates for an array of template parameters 
+    (tau, age, Nh, irlum, EBVbbb, EBVgal), normalised as in ymodel.
+
+    ## output:
+    - array (nwalkers, nbands, 4), with the starburst, BBB, galaxy 
+      and torus fluxes, in the order of the amplitudes in P.linear
+    """
+
+    tau, agelog, nh, irlum, BBebv, GAebv = pars.T
+
+    tau_dct, age_dct, ebvg_dct = dictkey_arrays.GALAXY(tau, 10**agelog, GAebv)
+
+    fluxes = lambda family, idx: dicts.double_precision_fluxes(dict_modelfluxes, family, dict_modelfluxes[family][idx])
+
+    if 'GALAXY_ebvpoly' in dict_modelfluxes:
+        gal_Fnu = 10**dicts.ebv_fluxes(dict_modelfluxes, 'GALAXY', dict_modelfluxes['GALAXY_ebvpoly'][tau_dct, age_dct], GAebv)
+    else:
+        gal_Fnu = fluxes('GALAXY', (tau_dct, age_dct, ebvg_dct))
+    if 'BBB_ebvpoly' in dict_modelfluxes:
+        bbb_Fnu = 10**dicts.ebv_fluxes(dict_modelfluxes, 'BBB', dict_modelfluxes['BBB_ebvpoly'], BBebv)
+    else:
+        bbb_Fnu = fluxes('BBB', dictkey_arrays.BBB(BBebv))
+
+    return np.dstack((fluxes('STARBURST', dictkey_arrays.STARBURST(irlum))/1e20,
+                      bbb_Fnu/1e60,
+                      gal_Fnu/1e18,
+                      fluxes('TORUS', dictkey_arrays.TORUS(nh))/1e-40))
+
+
+
+def fit_amplitudes(templates, lnlike, P, draw_matrix=False):
+
+    """Finds the amplitudes of the templates which minimise the chi**2
+    of the likelihood (LIKELIHOOD_KERNEL), not smaller than 10**P.min,
+    solving the least squares for every subset of free amplitudes.
+
+    ## inputs:
+    - templates, array (nwalkers, nbands, 4) from ymodel_templates
+    - lnlike, LIKELIHOOD_KERNEL of the source
+    - dictionary P
+
+    ## output:
+    - amplitudes, array (nwalkers, 4)
+    - chi2, array (nwalkers)
+    - with draw_matrix=True, also an array L (nwalkers, 4, 4) such that 
+      L.z, with z normal deviates, has the covariance of the free amplitudes
+      (those not at their limits), given the templates
+    """
+
+    nw, _, namp = templates.shape
+    Amin = 10**np.array(P.min)[list(P.linear)]
+
+    # weighted templates and data at the valid bands
+    w = np.sqrt(lnlike.invvar)
+    A = templates[:,lnlike.x_valid,:] * w[:,None]
+    y = (lnlike.y - np.dot(templates[:,lnlike.x_valid,:], Amin)) * w
+
+    # normalise the columns, for a better conditioned problem
+    norm = np.sqrt(np.sum(A**2, axis=1))
+    norm[norm == 0] = 1.
+    A = A/norm[:,None,:]
+    AtA = np.einsum('wbi,wbj->wij', A, A)
+    Aty = np.einsum('wbi,wb->wi', A, y)
+
+    best_chi2 = np.empty(nw)
+    best_chi2.fill(np.inf)
+    best_x = np.zeros((nw, namp))
+    best_free = np.zeros((nw, namp), dtype=bool)
+
+    if nw > 0:
+        for subset in range(2**namp):
+            free = np.array([(subset >> i) & 1 for i in range(namp)], dtype=bool)
+            x = np.zeros((nw, namp))
+            if free.any():
+                #the normalised AtA has a unit diagonal, a tiny ridge keeps it invertible
+                M = AtA[:,free][:,:,free] + 1e-12*np.eye(free.sum())
+                x[:,free] = np.linalg.solve(M, Aty[:,free][:,:,None])[:,:,0]
+            resid = y - np.einsum('wbi,wi->wb', A, x)
+            chi2 = np.sum(resid**2, axis=1)
+            better = np.all(x >= 0., axis=1) & (chi2 < best_chi2)
+            best_chi2[better] = chi2[better]
+            best_x[better] = x[better]
+            best_free[better] = free
+
+    amplitudes = Amin + best_x/norm
+
+    if not draw_matrix:
+        return amplitudes, best_chi2
+
+    # the inverse of the hessian of chi2/2 on the free amplitudes, as L.L^T
+    both_free = best_free[:,:,None] & best_free[:,None,:]
+    hessian = np.where(both_free, AtA, 0.) + np.eye(namp)*(~best_free[:,None,:])
+    val, vec = np.linalg.eigh(hessian)
+    val = np.where(val > 0, 1./np.sqrt(np.abs(val)), 0.)
+    L = vec * val[:,None,:] * best_free[:,:,None] / norm[:,:,None]
+
+    return amplitudes, best_chi2, L
+
+
+
+def add_amplitudes(chain, data, P, draw=True, random_state=np.random):
+
+    """Constructs the chain of all parameters from a chain of the template
+    parameters, sampled with ln_probab_marginalised, with the best-fitting amplitudes
+    (fit_amplitudes), or with draw=True, amplitudes drawn around them.
+
+    ## inputs:
+    - chain, array (..., len(P.nonlinear))
+    - object data
+    - dictionary P
+    - random_state, generator of the draws (np.random or a np.random.RandomState)
+
+    ## output:
+    - chain, array (..., len(P.names))
+    """
+
+    shape = chain.shape[:-1]
+    chain = chain.reshape(-1, chain.shape[-1])
+    Amin, Amax = [10**np.array(lim)[list(P.linear)] for lim in (P.min, P.max)]
+
+    amplitudes = np.empty((len(chain), len(P.linear)))
+    step = 10000
+    for i in range(0, len(chain), step):
+        templates = ymodel_templates(data.dictkey_arrays, data.dict_modelfluxes, chain[i:i+step])
+        amp, _, L = fit_amplitudes(templates, data.lnlike, P, draw_matrix=True)
+
+        if draw:
+            #draw again those outside the limits, a few times at most
+            pending = np.arange(len(amp))
+            for attempt in range(10):
+                z = random_state.normal(size=(len(pending), len(P.linear)))
+                a = amp[pending] + np.einsum('wij,wj->wi', L[pending], z)
+                ok = np.all((a >= Amin) & (a < Amax), axis=1)
+                amp[pending[ok]] = a[ok]
+                pending = pending[~ok]
+                if not len(pending):
+                    break
+
+        amplitudes[i:i+step] = amp
+
+    full = np.empty((len(chain), len(P.names)))
+    full[:,list(P.nonlinear)] = chain
+    full[:,list(P.linear)] = np.log10(amplitudes)
+
+    return full.reshape(shape + (len(P.names),))
 
 
 
@@ -135,7 +504,7 @@ def ymodel(data_nus, z, dictkey_arrays, dict_modelfluxes, *par):
 
     """Constructs the total model from parameter values.
 
-    ## inputs: data_nus, z, dictkey_arrays, dict_modelfluxes, *par
+    ## inputs: data_nus, z, dictkey_arrays (TEMPLATE_INDEX), dict_modelfluxes, *par
 
     ## output:
     - total model
@@ -148,50 +517,146 @@ def ymodel(data_nus, z, dictkey_arrays, dict_modelfluxes, *par):
     (2)in scriptPLOTandWRITE.
 
     """
-    STARBURSTFdict , BBBFdict, GALAXYFdict, TORUSFdict,_,_,_,_,_= dict_modelfluxes
-    gal_do, irlum_dict, nh_dict, BBebv_dict,_= dictkey_arrays
 
     # Call MCMC-parameter values 
     tau, agelog, nh, irlum, SB ,BB, GA,TO, BBebv, GAebv= par[0:10]
-    age = 10**agelog
-
-    # Pick dictionary key-values, nearest to the MCMC- parameter values
-    irlum_dct = model.pick_STARBURST_template(irlum, irlum_dict)
-    nh_dct = model.pick_TORUS_template(nh, nh_dict)
-    ebvbbb_dct = model.pick_BBB_template(BBebv, BBebv_dict)
-    gal_do.nearest_par2dict(tau, age, GAebv)
-    tau_dct, age_dct, ebvg_dct=gal_do.t, gal_do.a,gal_do.e
-
-    # Call fluxes from dictionary using keys-values
-    try: 
-        bands, gal_Fnu = GALAXYFdict[tau_dct, age_dct,ebvg_dct]     
-        bands, sb_Fnu= STARBURSTFdict[irlum_dct] 
-        bands, bbb_Fnu = BBBFdict[ebvbbb_dct] 
-        bands, tor_Fnu= TORUSFdict[nh_dct]
- 
-    except ValueError:
-        print 'Error: Dictionary does not contain some values'
+
+    gal_Fnu = ymodel_galaxy(dictkey_arrays, dict_modelfluxes, tau, agelog, GA, GAebv)
+    lum = ymodel_total(dictkey_arrays, dict_modelfluxes, gal_Fnu, nh, irlum, SB, BB, TO, BBebv)
+
+    lum = lum.reshape((np.size(lum),))    
+
+    return lum, dict_modelfluxes['bands'], gal_Fnu 
+
+
+
+def ymodel_batch(data_nus, z, dictkey_arrays, dict_modelfluxes, pars):
+
+    """Constructs the total models for an array of parameter vectors.
+
+    ## inputs: data_nus, z, dictkey_arrays, dict_modelfluxes, 
+    - pars, array of shape (nwalkers, len(P.names))
+
+    ## output:
+    - total models, array (nwalkers, nbands)
+    - bands
+    - galaxy_fluxes, array (nwalkers, nbands) (to be used by the luminosity prior)
+    """
+
+    # Call MCMC-parameter values 
+    tau, agelog, nh, irlum, SB ,BB, GA,TO, BBebv, GAebv= pars[:,0:10].T
+
+    gal_Fnu = ymodel_galaxy(dictkey_arrays, dict_modelfluxes, tau, agelog, GA, GAebv)
+    lum = ymodel_total(dictkey_arrays, dict_modelfluxes, gal_Fnu, nh, irlum, SB, BB, TO, BBebv)
+
+    return lum, dict_modelfluxes['bands'], gal_Fnu
+
+
+
+def ymodel_galaxy(dictkey_arrays, dict_modelfluxes, tau, agelog, GA, GAebv):
+
+    """Constructs the galaxy component of the model at the bands.
+    The parameters can be single values or arrays (one per walker).
+
+    ## output:
+    - galaxy fluxes, array (nbands) or (nwalkers, nbands)
+    """
+
+    # Pick dictionary indices, nearest to the MCMC- parameter values
+    tau_dct, age_dct, ebvg_dct = dictkey_arrays.GALAXY(tau, 10**agelog, GAebv)
+
+    if 'GALAXY_ebvpoly' in dict_modelfluxes:
+        return ymodel_ebv_polynomial(dict_modelfluxes, 'GALAXY', GA, 
+                                     dict_modelfluxes['GALAXY_ebvpoly'][tau_dct, age_dct], GAebv)
+
+    gal_Fnu = dict_modelfluxes['GALAXY'][tau_dct, age_dct,ebvg_dct]     
+
+    if 'lognorm' in dict_modelfluxes:
+        return ymodel_single_precision(dict_modelfluxes, 'GALAXY', GA, gal_Fnu)
 
     # Renormalize to have similar amplitudes. Keep these fixed!
-    sb_Fnu_norm = sb_Fnu.squeeze()/1e20    
-    bbb_Fnu_norm = bbb_Fnu.squeeze()/1e60
-    gal_Fnu_norm = gal_Fnu.squeeze()/1e18
-    tor_Fnu_norm = tor_Fnu.squeeze()/1e-40
+    return 10**(np.expand_dims(GA, -1))*gal_Fnu/1e18
+
+
+
+def ymodel_total(dictkey_arrays, dict_modelfluxes, gal_Fnu, nh, irlum, SB, BB, TO, BBebv):
+
+    """Constructs the total model at the bands, adding the starburst,
+    BBB and torus components to the galaxy fluxes of ymodel_galaxy.
+    The parameters can be single values or arrays (one per walker).
+
+    ## output:
+    - total model, array (nbands) or (nwalkers, nbands)
+    """
 
+    # Pick dictionary indices, nearest to the MCMC- parameter values
+    irlum_dct = dictkey_arrays.STARBURST(irlum)
+    nh_dct = dictkey_arrays.TORUS(nh)
+
+    # Call fluxes from dictionary arrays using the indices
+    sb_Fnu= dict_modelfluxes['STARBURST'][irlum_dct] 
+    tor_Fnu= dict_modelfluxes['TORUS'][nh_dct]
+
+    if 'BBB_ebvpoly' in dict_modelfluxes:
+        bbb = ymodel_ebv_polynomial(dict_modelfluxes, 'BBB', BB, dict_modelfluxes['BBB_ebvpoly'], BBebv)
+        if 'lognorm' in dict_modelfluxes:
+            return ymodel_single_precision(dict_modelfluxes, 'STARBURST', SB, sb_Fnu) + bbb + gal_Fnu \
+                   + ymodel_single_precision(dict_modelfluxes, 'TORUS', TO, tor_Fnu)
+        SB, TO = [np.expand_dims(N, -1) for N in (SB, TO)]
+        return 10**(SB)* sb_Fnu/1e20 + bbb + gal_Fnu  +(10**TO) *tor_Fnu/1e-40 
+
+    bbb_Fnu = dict_modelfluxes['BBB'][dictkey_arrays.BBB(BBebv)] 
+
+    if 'lognorm' in dict_modelfluxes:
+        return ymodel_single_precision(dict_modelfluxes, 'STARBURST', SB, sb_Fnu) \
+               + ymodel_single_precision(dict_modelfluxes, 'BBB', BB, bbb_Fnu) + gal_Fnu \
+               + ymodel_single_precision(dict_modelfluxes, 'TORUS', TO, tor_Fnu)
+
+    SB, BB, TO = [np.expand_dims(N, -1) for N in (SB, BB, TO)]
 
     # Total SED sum
     #--------------------------------------------------------------------
 
-    lum = 10**(SB)* sb_Fnu_norm + 10**(BB)*bbb_Fnu_norm    \
-          + 10**(GA)*gal_Fnu_norm  +(10**TO) *tor_Fnu_norm 
+    lum = 10**(SB)* sb_Fnu/1e20 + 10**(BB)*bbb_Fnu/1e60    \
+          + gal_Fnu  +(10**TO) *tor_Fnu/1e-40 
 
     #--------------------------------------------------------------------
 
-    lum = lum.reshape((np.size(lum),))    
+    return lum
 
-    return lum, bands, 10**(GA)*gal_Fnu_norm 
 
 
+# powers of ten of the renormalisation of each family in ymodel (1e20, 1e60, 1e18, 1e-40)
+LOG_RENORM = dict(STARBURST=20, BBB=60, GALAXY=18, TORUS=-40)
+
+def ymodel_single_precision(dict_modelfluxes, family, logamp, Fnu):
+
+    """Fluxes of one family of the model (amplitude times renormalised template),
+    for a dictionary in single precision (DICTIONARIES_AGNfitter.single_precision),
+    with the powers of ten added in log space to avoid the underflow of float32.
+
+    ## output:
+    - fluxes, float32 array (nbands) or (nwalkers, nbands)
+    """
+
+    logscale = np.expand_dims(logamp, -1) + (dict_modelfluxes['lognorm'][family] - LOG_RENORM[family])
+    return (10**logscale).astype(np.float32)*Fnu
+
+
+
+def ymodel_ebv_polynomial(dict_modelfluxes, family, logamp, coefs, ebv):
+
+    """Fluxes of the galaxy or BBB component of the model (amplitude times renormalised 
+    template), for a dictionary with the fluxes as polynomials in E(B-V)
+    (DICTIONARIES_AGNfitter.ebv_polynomial), evaluated at the E(B-V) of the parameters
+    instead of the nearest one of the grid.
+
+    ## output:
+    - fluxes, array (nbands) or (nwalkers, nbands)
+    """
+
+    logF = np.expand_dims(logamp, -1) - LOG_RENORM[family] + dicts.ebv_fluxes(dict_modelfluxes, family, coefs, ebv)
+    return (10**logF).astype(dict_modelfluxes['STARBURST'].dtype, copy=False)
 
 
 
@@ -202,13 +667,13 @@ def galaxy_Lumfct_prior( z, dlum, bands, gal_flux):
     (2)the Bband magnitude expected from the galaxy luminosity function
          given in Iovino et al. (2010)
     ## inputs:
-    -    z(float), dlum(float), bands(array), gal_flux (array)"""
+    -    z(float), dlum(float), bands(array), gal_flux (array (nbands) or (nwalkers, nbands))"""
 
     # Calculated B-band at this parameter space point
     h_70 = 1.
     lumfactor = (4. * pi * dlum**2.)
 
-    flux_B = gal_flux[(14.790 < bands)&(bands < 14.870)]
+    flux_B = gal_flux[...,(14.790 < bands)&(bands < 14.870)]
     mag1= -2.5 * np.log10(flux_B) - 48.6
     distmod = -5.0 * np.log10((dlum/3.08567758e24 *1e6)/10) 
     abs_mag1 = mag1 + distmod
@@ -225,11 +690,92 @@ def galaxy_Lumfct_prior( z, dlum, bands, gal_flux):
     return expected,thispoint
 
 
+
+class GALAXY_LUMFCT_PRIOR:
+
+    """
+    Class GALAXY_LUMFCT_PRIOR
+
+    The prior on the galaxy luminosity of ln_prior for one source, as a maximal
+    galaxy flux in the B band. Called with the galaxy fluxes, array (nbands) or 
+    (nwalkers, nbands), returns True where the prior is fulfilled.
+
+    ##input:
+    - z(float), dlum(float), bands(array)
+
+    ## dependencies:
+    - constructed in DATA.DICTS (DATA_AGNfitter.py), used by ln_prior and ln_probab_batch
+    """
+
+    def __init__(self, z, dlum, bands):
+
+        h_70 = 1.
+        lumfactor = (4. * pi * dlum**2.)
+
+        self.Bband = np.arange(len(bands))[(14.790 < bands)&(bands < 14.870)]
+        # Expected B-band calculation (Iovino et al. (2010))
+        expected = -20.3 - (5 * np.log10(h_70) )- (1.1 * z) 
+        # 51.6 - 2.5 *log10(lumfactor * flux_B) < expected - 5
+        self.flux_max = 10**((51.6 - (expected - 5))/2.5) / lumfactor
+
+    def __call__(self, gal_flux):
+
+        return ~np.any(gal_flux[...,self.Bband] > self.flux_max, axis=-1)
+
+
 """--------------------------------------
 Obtain initial positions
 --------------------------------------"""
 
 
+def precision_report(data, P, n=10000, seed=0):
+
+    """Compares the fit with the model dictionary of the source in single precision 
+    (DICTIONARIES_AGNfitter.single_precision) with the one in double precision,
+    at n positions drawn within the limits of P, and prints the largest differences.
+
+    ## inputs:
+    - object data, with its dictionary in double precision
+    - dictionary P
+    """
+
+    dict64 = data.dict_modelfluxes
+    if 'lognorm' in dict64:
+        print 'ERROR: the dictionary of the source is in single precision, no comparison possible.'
+        return
+    dict32 = dicts.single_precision(dict64)
+
+    rstate = np.random.RandomState(seed)
+    pars = np.array(P.min) + rstate.uniform(size=(n, len(P.names)))*(np.array(P.max) - np.array(P.min))
+
+    results = []
+    for d in dict64, dict32:
+        data.dict_modelfluxes = d
+        flux, _, _ = ymodel_batch(data.nus, data.z, data.dictkey_arrays, d, pars)
+        results.append((flux[:,data.lnlike.x_valid], ln_probab_batch(pars, data, P)))
+    data.dict_modelfluxes = dict64
+    (flux64, lnp64), (flux32, lnp32) = results
+
+    finite = np.isfinite(lnp64) & np.isfinite(lnp32)
+    relflux = np.abs(flux32 - flux64)/np.maximum(np.abs(flux64), 1e-300)
+
+    print '_____________________________________________________'
+    print 'Single precision (float32) against double precision, at %i positions:' % n
+    print '- size of the templates: %.3g MB against %.3g MB' % (
+        (dicts.templates_nbytes(dict32) + dicts.templates_nbytes(dicts.single_precision(data.library)))/1e6, 
+        (dicts.templates_nbytes(dict64) + dicts.templates_nbytes(data.library))/1e6)
+    print '- model fluxes at the valid bands: largest relative difference %.2g' % relflux.max()
+    print '- posterior: %i positions with different priors (of %i finite)' % (
+        np.count_nonzero(np.isfinite(lnp64) != np.isfinite(lnp32)), np.count_nonzero(np.isfinite(lnp64)))
+    if finite.any():
+        lnp32, lnp64 = lnp32[finite], lnp64[finite]
+        dlnp = np.abs(lnp32 - lnp64)
+        top = lnp64 >= np.percentile(lnp64, 99)
+        print '- ln posterior: largest relative difference %.2g' % (dlnp/np.abs(lnp64)).max()
+        print '- ln posterior at the 1%% most probable positions: largest difference %.2g' % dlnp[top].max()
+
+
+
 def get_initial_positions(nwalkers, P):
 
     """Returns the initial positions.
@@ -251,6 +797,28 @@ def get_initial_positions(nwalkers, P):
     return p0
 
 
+def load_samples(filename):
+
+    """Loads the dictionary of samples saved by MCMC_AGNfitter.save_chains.
+    If the chains were streamed to files ('chainfile', mc['chain_window']),
+    'chain' and 'lnprob' are memory-mapped from them: only the parts used
+    are read.
+    ## inputs:
+    - filename (str) of the .sav file
+    ## output:
+    - dictionary with 'chain', 'lnprob', 'accept', 'final_pos', 'state', 'acor'"""
+
+    f = open(filename, 'rb')
+    samples = pickle.load(f)
+    f.close()
+
+    if 'chainfile' in samples:
+        chainfile = emcee.backends.ChainFile(os.path.join(os.path.dirname(filename), samples['chainfile']))
+        samples['chain'], samples['lnprob'] = chainfile.chain, chainfile.lnprobability
+
+    return samples
+
+
 def get_best_position(filename, nwalkers, P):
 
     """Returns the best positions after burn-in phases.
@@ -261,14 +829,12 @@ def get_best_position(filename, nwalkers, P):
 
     Npar = len(P.names) 
     #all saved vectors    
-    f = open(filename, 'rb')
-    samples = pickle.load(f)
-    f.close()
+    samples = load_samples(filename)
 
-    #index for the largest likelihood     
-    i = samples['lnprob'].ravel().argmax()
+    #index (walker, step) for the largest likelihood     
+    i = np.unravel_index(samples['lnprob'].argmax(), samples['lnprob'].shape)
     #the values for the parameters at this index
-    P.ml = samples['chain'].reshape(-1, Npar)[i]
+    P.ml = samples['chain'][i]
 
     p1 = np.random.normal(size=(nwalkers, Npar))
 
@@ -35,7 +35,7 @@ from astropy import constants as const
 #AGNfitter IMPORTS
 import MODEL_AGNfitter as model
 import PARAMETERSPACE_AGNfitter as parspace
-import cPickle
+import DICTIONARIES_AGNfitter as dicts
 
 
 
@@ -62,6 +62,8 @@ def main(data, P, out):
     print 'Properties of the sampling results:'
     print '- Mean acceptance fraction', chain_mcmc.mean_accept
     print '- Mean autocorrelation time', chain_mcmc.mean_autocorr
+    if chain_mcmc.stop is not None:
+        print '- MCMC', chain_mcmc.stop
 
     output = OUTPUT(chain_mcmc, data)
 
@@ -79,7 +81,11 @@ def main(data, P, out):
 
     if out['writepar_meanwitherrors']:
         outputvalues, outputvalues_header = output.write_parameters_outputvalues(P)
-        comments_ouput= ' # Output for source ' +str(data.name) + '\n' +' Rows are: 2.5, 16, 50, 84, 97.5 percentiles, max likelihood # '+'\n'+ '-----------------------------------------------------'+'\n' 
+        comments_ouput= ' # Output for source ' +str(data.name)
+        if chain_mcmc.stop is not None:
+            #on the first line, not to change the number of lines of the header
+            comments_ouput += ', MCMC ' + chain_mcmc.stop
+        comments_ouput += '\n' +' Rows are: 2.5, 16, 50, 84, 97.5 percentiles, max likelihood # '+'\n'+ '-----------------------------------------------------'+'\n' 
         np.savetxt(data.output_folder + str(data.name)+'/parameter_outvalues_'+str(data.name)+'.txt' , outputvalues, delimiter = " ",fmt= "%1.4f" ,header= outputvalues_header, comments =comments_ouput)
 
     if out['plotSEDrealizations']:
@@ -321,14 +327,15 @@ class CHAIN:
 
     def props(self):
         if os.path.lexists(self.outputfilename):
-            f = open(self.outputfilename, 'rb')
-            samples = cPickle.load(f)
-            f.close()
+            samples = parspace.load_samples(self.outputfilename)
 
             self.chain = samples['chain']
             nwalkers, nsamples, npar = samples['chain'].shape
 
             Ns, Nt = self.out['Nsample'], self.out['Nthinning']        
+            if samples.get('independent'):
+                #independent draws of the grid fit (GRID_AGNfitter), not thinned
+                Nt = 1
             self.lnprob = samples['lnprob']
             self.lnprob_flat = samples['lnprob'][:,0:Ns*Nt:Nt].ravel()
 
@@ -346,6 +353,8 @@ class CHAIN:
 
             self.mean_accept =  samples['accept'].mean()
             self.mean_autocorr = samples['acor'].mean()
+            #why the sampling stopped, with mc['acor_every'] > 0
+            self.stop = samples.get('stop')
 
         else:
 
@@ -431,9 +440,15 @@ class FLUXES_ARRAYS:
             filtered_modelpoints_list = []
 
 
-        gal_do,  irlum_dict, nh_dict, BBebv_dict,_ = data.dictkey_arrays
-        # Take the last 4 dictionaries, which are for plotting. (the first 4 were at bands)
-        _,_,_,_,STARBURSTFdict , BBBFdict, GALAXYFdict, TORUSFdict,_= data.dict_modelfluxes
+        template_index = data.dictkey_arrays
+        # Take the arrays of the whole spectra, which are for plotting. (not those at bands)
+        # from the rest-frame library, shared by all redshifts 
+        # (the galaxy spectra are picked with dicts.galaxy_4plot)
+        STARBURSTFdict = data.library['STARBURST_4plot']
+        all_bbb_nus, BBBFdict = data.library['BBB_4plot']
+        all_tor_nus_dict, TORUSFdict = data.library['TORUS_4plot']
+        # in double precision, also for libraries stored in single precision
+        fluxes = lambda family, Fnus: dicts.double_precision_fluxes(data.library, family, Fnus)
 
         nsample, npar = self.chain_obj.flatchain.shape
         source = data.name
@@ -471,38 +486,50 @@ class FLUXES_ARRAYS:
         for g in range(len(tau)):
 
 
-            # Pick dictionary key-values, nearest to the MCMC- parameter values
-            irlum_dct = model.pick_STARBURST_template(irlum[g], irlum_dict)
-            nh_dct = model.pick_TORUS_template(nh[g], nh_dict)
-            ebvbbb_dct = model.pick_BBB_template(BBebv[g], BBebv_dict)
-            gal_do.nearest_par2dict(tau[g], age[g], GAebv[g])
-            tau_dct, age_dct, ebvg_dct=gal_do.t, gal_do.a,gal_do.e
+            # Pick dictionary indices, nearest to the MCMC- parameter values
+            irlum_dct = template_index.STARBURST(irlum[g])
+            nh_dct = template_index.TORUS(nh[g])
+            ebvbbb_dct = template_index.BBB(BBebv[g])
+            tau_dct, age_dct, ebvg_dct = template_index.GALAXY(tau[g], age[g], GAebv[g])
 
             #Produce model fluxes at all_nus_rest for plotting, through interpolation
-            all_gal_nus, gal_Fnus = GALAXYFdict[tau_dct, age_dct,ebvg_dct]   
+            if 'GALAXY_ebvpoly' in data.dict_modelfluxes:
+                #reddened at the E(B-V) of the parameters, as in the fit (DICTIONARIES_AGNfitter.ebv_polynomial)
+                ebvgal = data.dict_modelfluxes['ebvgal']
+                all_gal_nus, gal_Fnus = dicts.galaxy_4plot(data.library, tau_dct, age_dct, 0)
+                _, gal_Fnus = model.GALAXYred_Calzetti(10**all_gal_nus, gal_Fnus, 
+                                                       np.clip(GAebv[g], ebvgal[0], ebvgal[-1]) - ebvgal[0])
+            else:
+                all_gal_nus, gal_Fnus = dicts.galaxy_4plot(data.library, tau_dct, age_dct, ebvg_dct)
             GAinterp = scipy.interpolate.interp1d(all_gal_nus, gal_Fnus, bounds_error=False, fill_value=0.)
             all_gal_Fnus = GAinterp(self.all_nus_rest)
 
             all_sb_nus, sb_Fnus= STARBURSTFdict[irlum_dct] 
+            sb_Fnus = fluxes('STARBURST', sb_Fnus)
             SBinterp = scipy.interpolate.interp1d(all_sb_nus, sb_Fnus, bounds_error=False, fill_value=0.)
             all_sb_Fnus = SBinterp(self.all_nus_rest)
 
-            all_bbb_nus, bbb_Fnus = BBBFdict[ebvbbb_dct] 
+            if 'BBB_ebvpoly' in data.dict_modelfluxes:
+                ebvbbb = data.dict_modelfluxes['ebvbbb']
+                _, bbb_Fnus = model.BBBred_Prevot(all_bbb_nus, fluxes('BBB', BBBFdict[0]), 
+                                                  np.clip(BBebv[g], ebvbbb[0], ebvbbb[-1]) - ebvbbb[0], data.z)
+            else:
+                bbb_Fnus = fluxes('BBB', BBBFdict[ebvbbb_dct])
             BBinterp = scipy.interpolate.interp1d(all_bbb_nus, bbb_Fnus, bounds_error=False, fill_value=0.)
             all_bbb_Fnus = BBinterp(self.all_nus_rest)
 
-            all_bbb_nus, bbb_Fnus_deredd = BBBFdict['0.0']
+            bbb_Fnus_deredd = fluxes('BBB', BBBFdict[0])
             BBderedinterp = scipy.interpolate.interp1d(all_bbb_nus, bbb_Fnus_deredd, bounds_error=False, fill_value=0.)
             all_bbb_Fnus_deredd = BBderedinterp(self.all_nus_rest)
 
-            all_tor_nus, tor_Fnus= TORUSFdict[nh_dct]
+            all_tor_nus, tor_Fnus= all_tor_nus_dict[nh_dct], fluxes('TORUS', TORUSFdict[nh_dct])
             TOinterp = scipy.interpolate.interp1d(all_tor_nus, np.log10(tor_Fnus), bounds_error=False, fill_value=0.)
             all_tor_Fnus = 10**(TOinterp(self.all_nus_rest))        
 
 
             if self.output_type == 'plot':
                 par2 = tau[g], agelog[g], nh[g], irlum[g], SB[g] ,BB[g], GA[g] ,TO[g], BBebv[g], GAebv[g]
-                filtered_modelpoints, _, _ = parspace.ymodel(data.nus,data.z, data.dictkey_arrays, data.dict_modelfluxes, *par2)
+                filtered_modelpoints, _, _ = parspace.ymodel(data.nus,data.z, template_index, data.dict_modelfluxes, *par2)
                 
 
             #Using the costumized normalization 
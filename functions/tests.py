@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Tests of the model dictionary and of the fitting functions on the example
+catalog, against the implementations they replace. Run them with
+
+    python -c "from functions import tests; tests.test()"
+
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from astropy import units as u
+
+import MODEL_AGNfitter as model
+import PARAMETERSPACE_AGNfitter as parspace
+import DICTIONARIES_AGNfitter as dicts
+import GRID_AGNfitter as grid
+from DATA_AGNfitter import DATA, DATA_all
+
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + '/'
+
+
+def example_settings(workingpath):
+    """
+    Catalog and filter settings of the example (example/SETTINGS_AGNfitter.py),
+    with the paths of this copy of the code and the given working path.
+    """
+    settings = dict(np=np, u=u)
+    execfile(PATH + 'example/SETTINGS_AGNfitter.py', settings)
+    cat, filters = settings['CATALOG_settings'](), settings['FILTERS_settings']()
+    cat['path'] = PATH
+    cat['filename'] = PATH + 'data/catalog_example.txt'
+    cat['workingpath'] = workingpath
+    cat['output_folder'] = workingpath + 'OUTPUT/'
+    cat['dict_path'] = workingpath + 'MODELSDICT_test'
+    return cat, filters
+
+
+def same(a, b, rtol=0.):
+    """
+    True if the (nested) dictionaries, tuples or lists a and b hold the same
+    values, with the arrays equal to the relative tolerance rtol.
+    """
+    if isinstance(a, dict):
+        return sorted(a) == sorted(b) and all(same(a[k], b[k], rtol) for k in a)
+    if isinstance(a, (tuple, list)):
+        return len(a) == len(b) and all(same(x, y, rtol) for x, y in zip(a, b))
+    if isinstance(a, np.ndarray):
+        return a.shape == np.shape(b) and a.dtype == b.dtype and \
+            np.allclose(a, b, rtol=rtol, atol=0., equal_nan=True)
+    return a == b
+
+
+class Tests(object):
+
+    def setUp(self):
+        self.workingpath = tempfile.mkdtemp() + '/'
+        self.cat, self.filters = example_settings(self.workingpath)
+        self.filters['dict_zarray'] = np.array([0.283])
+
+    def tearDown(self):
+        shutil.rmtree(self.workingpath, ignore_errors=True)
+
+    def source(self, line=0):
+        Modelsdict = dicts.MODELSDICT(self.cat['dict_path'], PATH, self.filters).build(save=False)
+        data_ALL = DATA_all(self.cat)
+        data_ALL.PROPS()
+        data = DATA(data_ALL, line)
+        data.DICTS(self.filters, Modelsdict)
+        return data, parspace.Pdict(data)
+
+    def test_grid_chi2(self):
+        # the chi**2 of the grid fitting against fit_amplitudes, on some
+        # galaxy templates and all combinations of the other templates
+        data, P = self.source()
+        thinning = dict(tau=1, age=2, Nh=6, irlum=8, EBVbbb=2, EBVgal=2)
+        fit = grid.GRID(data, P, thinning)
+        g = np.arange(0, fit.shape[0], max(1, fit.shape[0] // 5))
+        chi2 = fit.chi2((np.array([0]), g, np.arange(fit.shape[1])))[0].reshape(len(g), -1)
+
+        nrest = chi2.shape[1]
+        pars = fit.combination((g[:, None]*nrest + np.arange(nrest)).ravel())
+        templates = parspace.ymodel_templates(data.dictkey_arrays, data.dict_modelfluxes, pars)
+        amplitudes, chi2_fit = parspace.fit_amplitudes(templates, data.lnlike, P)
+        feasible = np.all(amplitudes < 10**np.array(P.max)[list(P.linear)], axis=1) & \
+            data.lumfct_prior(amplitudes[:, 2, None]*templates[..., 2])
+        chi2 = chi2.ravel()
+
+        assert np.array_equal(np.isfinite(chi2), feasible)
+        assert feasible.any()
+        assert np.allclose(chi2[feasible], chi2_fit[feasible], rtol=1e-10, atol=0.)
+
+    def test_filters_matrix(self):
+        # the fluxes of FILTER_PROJECTION against those of filters1
+        filterdict = dicts.filter_dictionaries(self.filters['Bandset'], PATH, self.filters)
+        nus = np.linspace(11., 16.5, 700)
+        fluxes = np.random.RandomState(0).lognormal(size=(3, len(nus)))
+        for z in (0.283, 1.58):
+            bands, projected = model.FILTER_PROJECTION(filterdict, z)(nus, fluxes)
+            for i in range(len(fluxes)):
+                bands1, filtered = model.filters1(nus, fluxes[i], filterdict, z)
+                assert np.array_equal(bands, bands1)
+                assert np.allclose(projected[i], np.ravel(filtered), rtol=1e-12, atol=0.)
+
+    def test_update(self):
+        # a dictionary completed by MODELSDICT.update against a new one
+        self.filters['dict_zarray'] = np.array([0.283, 1.58])
+        full = dicts.MODELSDICT(self.cat['dict_path'], PATH, self.filters).build(save=False)
+        part = dict(full)
+        del part['1.58']
+        bands = part['0.283']['bands']
+        part['0.283'] = dicts.select_bands(part['0.283'], np.delete(bands, [0, 7]))
+
+        modelsdict = dicts.MODELSDICT(self.cat['dict_path'], PATH, self.filters)
+        assert modelsdict.update(part) == 2
+        assert same(dicts.load_modelsdict(self.cat['dict_path']), full, rtol=1e-12)
+        assert modelsdict.update(part) == 0
+
+    def test_sharded(self):
+        # a SHARDED_MODELSDICT against the dictionary it is built from
+        self.filters['dict_zarray'] = np.array([0.283, 1.58])
+        ref = dicts.MODELSDICT(self.cat['dict_path'], PATH, self.filters).build(save=False)
+        self.filters['dict_sharded'] = True
+        dicts.MODELSDICT(self.cat['dict_path'], PATH, self.filters).build()
+
+        sharded = dicts.load_modelsdict(self.cat['dict_path'])
+        assert isinstance(sharded, dicts.SHARDED_MODELSDICT)
+        assert sorted(sharded.keys()) == sorted(ref)
+        for key in ref:
+            assert same(sharded[key], ref[key])
+        assert isinstance(sharded['0.283']['GALAXY'], np.memmap)
+
+
+def test():
+    from inspect import getmembers, ismethod
+
+    print("Starting tests...")
+    failures = 0
+    tests = Tests()
+    for o in getmembers(tests):
+        if ismethod(o[1]) and o[0].startswith("test"):
+            tests.setUp()
+            print("{0} ...".format(o[0]))
+            try:
+                o[1]()
+            except Exception as e:
+                print("Failed with:\n    {0.__class__.__name__}: {0}"
+                      .format(e))
+                failures += 1
+            else:
+                print("    Passed.")
+            tests.tearDown()
+
+    print("{0} tests failed".format(failures))